@@ -15,7 +15,15 @@ Then we implement various functions for doing logical inference:
     tt_entails       Say if a statement is entailed by a KB
     pl_resolution    Do resolution on propositional sentences
     dpll_satisfiable See if a propositional sentence is satisfiable
-    WalkSAT          (not yet implemented)
+    cdcl_satisfiable The same, with a conflict-driven clause learning solver
+    CNF              Clauses compiled to signed ints, with DIMACS input/output
+    WalkSAT          Local search for a model, with ProbSAT as an option
+    portfolio_satisfiable  Race several SAT solvers in a process pool
+    CompiledKB       A propositional KB compiled into a BDD
+    model_count      Count (weighted) models, and get marginal probabilities
+    fol_fc_ask       Forward chaining on FOL definite clauses, by Rete network
+    fol_bc_ask       Backward chaining on FOL definite clauses
+    DatalogKB        Bottom-up, semi-naive evaluation of Datalog clauses
 
 And a few other functions:
 
@@ -24,7 +32,7 @@ And a few other functions:
     diff, simp       Symbolic differentiation and simplification
 """
 
-import itertools, re
+import collections, heapq, itertools, random, re, weakref
 import agents
 from utils import *
 
@@ -65,27 +73,463 @@ class KB:
 
 
 class PropKB(KB):
-    "A KB for propositional logic. Inefficient, with no indexing."
-
-    def __init__(self, sentence=None):
+    """A KB for propositional logic. Inefficient, with no indexing.
+    Sentences are converted to clauses by to_cnf, in the KB's cnf_mode
+    unless tell is given another mode; with cnf_mode='tseitin' the clauses
+    include auxiliary symbols (see tseitin_cnf).  With a cache_size, the
+    answers of ask are kept in an AskCache of that many entries.  With
+    slicing, each query is checked against only the clauses a KBSlicer
+    finds can bear on it, rather than all of them."""
+
+    def __init__(self, sentence=None, cnf_mode='distribute', cache_size=0,
+                 slicing=False):
         self.clauses = []
+        self.cnf_mode = cnf_mode
+        self.cache = self.slicer = None
+        if cache_size:
+            self.cache = AskCache(cache_size)
+        if slicing:
+            self.slicer = KBSlicer()
         if sentence:
             self.tell(sentence)
 
-    def tell(self, sentence):
+    def tell(self, sentence, mode=None):
         "Add the sentence's clauses to the KB."
-        self.clauses.extend(conjuncts(to_cnf(sentence)))
+        clauses = conjuncts(to_cnf(sentence, mode or self.cnf_mode))
+        self.clauses.extend(clauses)
+        if self.slicer:
+            self.slicer.told(clauses)
+        if self.cache:
+            self.cache.told(self, clauses)
+
+    def ask(self, query):
+        "Like KB.ask, but through the cache if there is one."
+        if self.cache:
+            return self.cache.ask(self, query)
+        return KB.ask(self, query)
 
     def ask_generator(self, query):
         "Yield the empty substitution if KB implies query; else nothing."
-        if tt_entails(Expr('&', *self.clauses), query):
+        if not self.slicer:
+            if tt_entails(Expr('&', *self.clauses), query):
+                yield {}
+        elif (tt_entails(associate('&', self.slicer.slice(query)), query)
+              or not self.slicer.consistent(self)):
             yield {}
 
-    def retract(self, sentence):
-        "Remove the sentence's clauses from the KB."
-        for c in conjuncts(to_cnf(sentence)):
+    def retract(self, sentence, mode=None):
+        """Remove the sentence's clauses from the KB.  The mode must be the
+        one the sentence was told with."""
+        for c in conjuncts(to_cnf(sentence, mode or self.cnf_mode)):
             if c in self.clauses:
                 self.clauses.remove(c)
+        if self.slicer:
+            self.slicer.reset(self)
+        if self.cache:
+            self.cache.reset(self)
+
+    def compile(self, symtab=None):
+        "Return the KB's clauses compiled to a CNF of integer clauses."
+        return compile_clauses(self.clauses, symtab)
+
+    def ask_many(self, queries):
+        """Generate the answer ask would give ({} or False) to each of the
+        queries, in order, from a snapshot of the KB taken now.  The clauses
+        are compiled once, into an IncrementalPropKB, so the queries share
+        one solver: its unit propagation of the KB's unit clauses (such as
+        percepts), its learned clauses, and the models it finds.  Queries
+        after the point where the caller stops are never worked on.
+        >>> kb = PropKB(Fig[7,13])
+        >>> list(kb.ask_many([expr('~P12'), expr('P21'), expr('~P12 & ~P21')]))
+        [{}, False, {}]
+        """
+        kb = IncrementalPropKB(cnf_mode=self.cnf_mode)
+        kb.clauses = list(self.clauses)
+        for clause in self.compile(kb.symtab).clauses:
+            kb.solver.add_clause(clause)
+        return kb.ask_many(queries)
+
+    def backbone(self, symbols):
+        """Say which of the symbols the KB forces: return a dict mapping each
+        to True or False if the KB entails it or its negation, and to None
+        if it does not; or None if the KB is unsatisfiable.  This takes one
+        CDCL solver session; see solver_backbone.
+        >>> ppsubst(PropKB(expr('(A | B) & ~B & (C | D)')).backbone([A, B, C]))
+        {A: True, B: False, C: None}
+        """
+        symtab = SymbolTable()
+        solver = CDCLSolver(self.compile(symtab).clauses)
+        return solver_backbone(solver, symtab, symbols)
+
+
+class IncrementalPropKB(PropKB):
+    """A PropKB backed by one persistent CDCL solver.  Each tell adds its
+    clauses to the solver, and ask(alpha) checks each clause of alpha by
+    solving under the assumption that all its literals are false; that is
+    unsatisfiable iff the KB entails the clause.  Since nothing is asserted
+    for a query, the solver's learned clauses and variable activities carry
+    over from one query to the next.  The models found along the way are
+    kept as witnesses: a clause that some witness falsifies is not entailed,
+    without calling the solver at all, and a tell only has to check its new
+    clauses against the witnesses.  A retract rebuilds the solver.
+    >>> kb = IncrementalPropKB(Fig[7,13])
+    >>> kb.ask(expr('~P12')), kb.ask(expr('P12')), kb.ask(expr('~P12 & ~P21'))
+    ({}, False, {})
+    >>> kb.retract(expr('~B11'))
+    >>> kb.ask(expr('~P12'))
+    False
+    """
+
+    max_witnesses = 16
+
+    def __init__(self, sentence=None, cnf_mode='distribute', cache_size=0):
+        self.symtab = SymbolTable()
+        self.solver = CDCLSolver()
+        self.witnesses = []  ## Models (lists indexed by variable) of the KB
+        PropKB.__init__(self, sentence, cnf_mode, cache_size)
+
+    def tell(self, sentence, mode=None):
+        "Add the sentence's clauses to the KB and to the solver."
+        clauses = conjuncts(to_cnf(sentence, mode or self.cnf_mode))
+        for c in clauses:
+            self.clauses.append(c)
+            clause = self.symtab.clause(c)
+            if clause is not None:
+                self.solver.add_clause(clause)
+                self.witnesses = [m for m in self.witnesses
+                                  if some(lambda n: abs(n) < len(m)
+                                          and m[abs(n)] == (n > 0), clause)]
+        if self.cache:
+            self.cache.told(self, clauses)
+
+    def ask_generator(self, query):
+        "Yield the empty substitution if KB implies query; else nothing."
+        if self.entails(query):
+            yield {}
+
+    def entails(self, query):
+        "Does the KB entail the query?"
+        for c in conjuncts(to_cnf(query)):
+            clause = self.symtab.clause(c)
+            if clause is not None and not self.entails_clause(clause):
+                return False
+        return True
+
+    def ask_many(self, queries):
+        """Like PropKB.ask_many, but on the KB itself, which should not be
+        told anything until the answers are all in.  Each distinct query is
+        converted once, and each distinct clause checked once."""
+        answers, checked = {}, {}  ## query -> answer, clause -> entailed
+        for query in queries:
+            if query not in answers:
+                answers[query] = True
+                for c in conjuncts(to_cnf(query)):
+                    clause = self.symtab.clause(c)
+                    if clause is None: continue
+                    clause = tuple(sorted(clause))
+                    if clause not in checked:
+                        checked[clause] = self.entails_clause(clause)
+                    if not checked[clause]:
+                        answers[query] = False
+                        break
+            yield if_(answers[query], {}, False)
+
+    def entails_clause(self, clause):
+        "Does the KB entail the clause, given as a tuple of ints?"
+        if some(self.solver.fixed, clause):
+            return True
+        for m in self.witnesses:
+            ## Variables the model does not cover are not in any KB clause.
+            if every(lambda n: abs(n) >= len(m) or m[abs(n)] != (n > 0),
+                     clause):
+                return False
+        if self.solver.solve([-n for n in clause]):
+            self.witnesses.insert(0, self.solver.model)
+            del self.witnesses[self.max_witnesses:]
+            return False
+        return True
+
+    def backbone(self, symbols):
+        """Like PropKB.backbone, but with the KB's own solver, starting from
+        its witnesses and keeping the models it finds as witnesses."""
+        result = solver_backbone(self.solver, self.symtab, symbols,
+                                 self.witnesses)
+        del self.witnesses[self.max_witnesses:]
+        return result
+
+    def retract(self, sentence, mode=None):
+        "Remove the sentence's clauses from the KB, and rebuild the solver."
+        PropKB.retract(self, sentence, mode)
+        self.solver = CDCLSolver(compile_clauses(self.clauses, self.symtab).clauses)
+
+class AskCache:
+    """A least recently used cache of the answers to ask of a PropKB, which
+    stays valid as the KB grows.  Entailment is monotonic, so an entailed
+    query stays entailed after a tell.  A query that is not entailed only
+    has to be asked again once a told clause shares a symbol with its
+    cone: the symbols linked to the query's through chains of clauses that
+    share symbols.  Clauses outside the cone can only change the answer by
+    making the KB inconsistent, so when such answers are kept, the cache's
+    own CDCL solver, which is told each clause as the KB is, makes sure it
+    is not.  A retract empties the cache and rebuilds the solver.
+    hits and misses count the answers found in the cache and not.
+    >>> kb = PropKB(expr('B11 <=> (P12 | P21)'), cache_size=10)
+    >>> kb.ask(expr('~P12')), kb.tell(expr('~W33')), kb.ask(expr('~P12'))
+    (False, None, False)
+    >>> kb.tell(expr('~B11')); kb.ask(expr('~P12'))
+    {}
+    >>> kb.cache.hits, kb.cache.misses
+    (1, 2)
+    >>> kb = IncrementalPropKB(expr('B11 <=> (P12 | P21)'), cache_size=10)
+    >>> kb.ask('~P12'), kb.tell(expr('~B11')), kb.ask('~P12')
+    (False, None, {})
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict() ## query -> (answer, symbols)
+        self.parent = {}  ## Union-find forest over the symbols of the clauses
+        self.symtab, self.solver = SymbolTable(), CDCLSolver()
+        self.hits = self.misses = 0
+
+    def ask(self, kb, query):
+        "Answer the query (a sentence or string) from the cache, or by KB.ask."
+        query = expr(query)
+        entry = self.entries.pop(query, None)
+        if entry is None:
+            self.misses += 1
+            entry = (KB.ask(kb, query) is not False, prop_symbols(query))
+        else:
+            self.hits += 1
+        self.entries[query] = entry  ## Now the most recently used
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return if_(entry[0], {}, False)
+
+    def find(self, s):
+        root = self.parent.setdefault(s, s)
+        while root != self.parent[root]:
+            root = self.parent[root]
+        while s != root:
+            s, self.parent[s] = self.parent[s], root
+        return root
+
+    def told(self, kb, clauses):
+        """Link the symbols of the clauses just told to kb, and drop the
+        answers they affect."""
+        touched = []
+        for c in clauses:
+            clause = self.symtab.clause(c)
+            if clause is not None:
+                self.solver.add_clause(clause)
+            symbols = prop_symbols(c)
+            for s in symbols[1:]:
+                self.parent[self.find(s)] = self.find(symbols[0])
+            touched.extend(symbols)
+        roots = set(map(self.find, touched))
+        kept = False
+        for query, (entailed, symbols) in self.entries.items():
+            if not entailed:
+                if some(lambda s: self.find(s) in roots, symbols):
+                    del self.entries[query]
+                else:
+                    kept = True
+        if kept and not self.solver.solve():
+            self.entries.clear()  ## The KB is now inconsistent
+
+    def reset(self, kb):
+        "Drop every answer, and link the symbols of kb's clauses."
+        self.entries.clear()
+        self.parent.clear()
+        self.symtab, self.solver = SymbolTable(), CDCLSolver()
+        self.told(kb, kb.clauses)
+
+class KBSlicer:
+    """An index from each symbol to the clauses of a PropKB that it occurs
+    in, kept up to date as the KB is told things, from which slice picks
+    out the clauses that can bear on a query.  Three things cut a query
+    off from the rest of the KB.  A clause that a unit clause (a percept,
+    say) satisfies cannot matter, and neither can a clause through a
+    symbol the unit clauses fix, other than by that symbol's value.  And
+    a symbol that the query does not mention, and whose clauses (less
+    what the unit clauses settle) just define it in terms of other
+    symbols, as B11 <=> (P12 | P21) does, or only mention it one way
+    round, can always be given a value that makes them true, so its
+    clauses can be dropped.  What is left, the clauses that can be reached
+    from the query's symbols, entails the query iff the whole KB does,
+    provided the KB is consistent; so a query that the slice does not
+    entail is only answered False once the KB has been found satisfiable
+    (see consistent).
+    >>> kb = PropKB(slicing=True)
+    >>> for x, y in [(1, 1), (1, 2), (2, 1), (2, 2), (3, 1), (3, 2)]:
+    ...     kb.tell(expr('B%d%d <=> (P%d%d | P%d%d | P%d%d | P%d%d)'
+    ...                  % (x, y, x-1, y, x+1, y, x, y-1, x, y+1)))
+    >>> kb.tell(expr('~B11 & ~P11 & B21 & ~P21'))
+    >>> kb.slicer.slice(expr('P12')), kb.slicer.slice(expr('P31'))
+    ([(~P12 | B11), ~B11], [])
+    >>> kb.ask(expr('~P12')), kb.ask(expr('P31'))
+    ({}, False)
+    """
+
+    def __init__(self):
+        self.occurs = {}  ## symbol -> the clauses it occurs in
+        self.units = {}   ## symbol -> the value a unit clause gives it
+        self.satisfiable = None  ## Is the KB satisfiable? None if unknown
+        self.pending = [] ## Clauses told since then, and their unit clauses
+
+    def told(self, clauses):
+        "Index the clauses just told to the KB."
+        for c in clauses:
+            symbols = prop_symbols(c)
+            for s in symbols:
+                self.occurs.setdefault(s, []).append(c)
+            literals = disjuncts(c)
+            if len(literals) == 1 and symbols:
+                s, value = inspect_literal(literals[0])
+                self.units[s] = value
+                self.pending.extend(self.occurs[s])
+            else:
+                self.pending.append(c)
+
+    def reset(self, kb):
+        "Index the clauses of kb afresh."
+        self.occurs.clear()
+        self.units.clear()
+        self.satisfiable = None
+        self.told(kb.clauses)
+
+    def consistent(self, kb):
+        """Is kb, whose clauses these are, satisfiable?  Once it has been
+        found to be, only the cone of the clauses told since then, and of
+        the clauses with the symbols their unit clauses fix, needs to be
+        checked: outside it, a model of the KB as it was still works."""
+        if self.satisfiable is None:
+            cnf = kb.compile()
+        elif self.satisfiable and self.pending:
+            cnf = compile_clauses(self.cone([], self.pending))
+        else:
+            return self.satisfiable
+        self.satisfiable = CDCLSolver(cnf.clauses, cnf.nvars).solve()
+        self.pending = []
+        return self.satisfiable
+
+    def open_literals(self, clause):
+        """The literals of the clause that the unit clauses leave open, or
+        None if they make one of its literals true."""
+        literals = []
+        for literal in disjuncts(clause):
+            s, value = inspect_literal(literal)
+            if s not in self.units:
+                literals.append(literal)
+            elif self.units[s] == value:
+                return None
+        return literals
+
+    def eliminable(self, s):
+        """Can s, which the unit clauses must not fix, be given a value that
+        makes its clauses true whatever the values of the other symbols?
+        It can if the open literals of its clauses are all s, or all ~s, or
+        say l <=> ~a1 & ... & ~ak, as the clause (l | a1 | ... | ak) and the
+        clauses (~l | ~ai), for l one of s and ~s.  (See
+        ModelCounter.is_definition.)"""
+        cs = [frozenset(literals) for literals in
+              map(self.open_literals, self.occurs[s]) if literals is not None]
+        if every(lambda c: s in c, cs) or every(lambda c: ~s in c, cs):
+            return True
+        for l in (s, ~s):
+            long = [c for c in cs if l in c]
+            if len(long) != 1:
+                continue
+            binaries = set(frozenset([negate_literal(l), negate_literal(a)])
+                           for a in long[0] if a != l)
+            rest = set(c for c in cs if c is not long[0])
+            if len(rest) == len(cs) - 1 == len(binaries) and rest == binaries:
+                return True
+        return False
+
+    def slice(self, query):
+        """The clauses that can bear on the query: those reachable from its
+        symbols, through symbols the unit clauses do not fix, and the unit
+        clauses of the symbols reached."""
+        return self.cone(prop_symbols(query), [])
+
+    def cone(self, symbols, clauses):
+        """The clauses reachable from the symbols, which are kept, or from
+        the clauses, which are taken first, and the unit clauses of the
+        symbols reached."""
+        reached, dropped, seen = set(symbols), {}, set()
+        symbols, result = list(symbols), []
+        def reach(c):
+            if id(c) in seen or self.open_literals(c) is None:
+                return
+            seen.add(id(c))
+            others = [t for t in prop_symbols(c) if t not in reached]
+            for t in others:
+                if t not in dropped:
+                    dropped[t] = t not in self.units and self.eliminable(t)
+            if not some(dropped.get, others):
+                result.append(c)
+                reached.update(others)
+                symbols.extend(others)
+        for c in clauses:
+            reach(c)
+        while symbols:
+            s = symbols.pop()
+            if s in self.units:
+                if self.units[s]:
+                    result.append(s)
+                else:
+                    result.append(~s)
+                continue
+            for c in self.occurs.get(s, []):
+                reach(c)
+        return result
+
+def solver_backbone(solver, symtab, symbols, models=None):
+    """Find which of the symbols take the same value in every model of the
+    solver's clauses, with the symbols numbered by symtab.  The first model
+    found gives each symbol a candidate value, and the candidates are then
+    tested one at a time: the solver is asked for a model under the
+    assumption that the candidate is flipped, preferring the negations of
+    all the candidates left.  If there is none, the candidate is forced,
+    and is added as a unit clause to help the later tests; otherwise the
+    model rules out every candidate it flips, which with those phases is
+    usually a good many.  A candidate the unit clauses fix already needs
+    no test.  Since only assumptions and entailed unit clauses are given
+    to the solver, a persistent solver (as in IncrementalPropKB) does not
+    grow with each call.  Models, if given, is a list of known models of
+    the clauses, which rule out candidates first; the models found are
+    inserted at its front.  Return a dict {symbol: True, False or None},
+    or None if the clauses are unsatisfiable.
+    """
+    if models is None: models = []
+    variables = [symtab.intern(s) for s in symbols]
+    solver.ensure_vars(len(symtab))
+    if not solver.solve():
+        return None
+    models.insert(0, solver.model)
+    candidates = dict((v, solver.model[v]) for v in variables)
+    def rule_out(model):
+        for v, value in candidates.items():
+            if v >= len(model) or model[v] != value:
+                del candidates[v]
+    for model in models:
+        rule_out(model)
+    forced = {}
+    for v in sorted(candidates):
+        if v not in candidates:
+            continue
+        lit = if_(candidates[v], v, -v)
+        if solver.fixed(lit) is None:
+            for w, value in candidates.items():
+                solver.prefer(if_(value, -w, w))
+            if solver.solve([-lit]):
+                models.insert(0, solver.model)
+                rule_out(solver.model)
+                continue
+            solver.add_clause([lit])
+        forced[v] = candidates.pop(v)
+    return dict((s, forced.get(v)) for s, v in zip(symbols, variables))
 
 #______________________________________________________________________________
 
@@ -113,7 +557,7 @@ def KB_AgentProgram(KB):
 
 #______________________________________________________________________________
 
-class Expr:
+class Expr(object):
     """A symbolic mathematical expression.  We use this class for logical
     expressions, and for terms within logical expressions. In general, an
     Expr has an op (operator) and a list of args.  The op can be:
@@ -157,13 +601,38 @@ class Expr:
     1 doesn't know how to add an Expr.  (Adding an __radd__ method to Expr
     wouldn't help, because int.__add__ is still called first.) Therefore,
     you should use Expr(1) + x instead, or ONE + x, or expr('1 + x').
+
+    Exprs are immutable and hash-consed: constructing an Expr whose op and
+    args are equal to those of a live Expr returns that same object.  So the
+    args are a tuple, the hash is computed once at construction, and x == y
+    is just an identity test.  The intern table holds its Exprs weakly, so
+    Exprs that are no longer referenced are still garbage collected.
     """
 
-    def __init__(self, op, *args):
-        "Op is a string or number; args are Exprs (or are coerced to Exprs)."
+    __slots__ = ('op', 'args', '_hash', '__weakref__')
+
+    def __new__(cls, op, *args):
+        """Op is a string or number; args are Exprs (or are coerced to Exprs).
+        Structurally equal Exprs are interned as one shared object."""
         assert isinstance(op, str) or (isnumber(op) and not args)
-        self.op = num_or_str(op)
-        self.args = map(expr, args) ## Coerce args to Exprs
+        if not (isinstance(op, str) and (op[:1].isalpha() or op in _expr_ops)):
+            op = num_or_str(op)
+        for a in args:
+            if not isinstance(a, Expr):
+                args = tuple(map(expr, args)) ## Coerce args to Exprs
+                break
+        key = (op, args)
+        self = _expr_table.get(key)
+        if self is None:
+            self = object.__new__(cls)
+            object.__setattr__(self, 'op', op)
+            object.__setattr__(self, 'args', args)
+            object.__setattr__(self, '_hash', hash(op) ^ hash(args))
+            _expr_table[key] = self
+        return self
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Expr objects are immutable")
 
     def __call__(self, *args):
         """Self must be a symbol with no args, such as Expr('F').  Create a new
@@ -183,16 +652,26 @@ class Expr:
             return '(%s)' % (' '+self.op+' ').join(map(repr, self.args))
 
     def __eq__(self, other):
-        """x and y are equal iff their ops and args are equal."""
-        return (other is self) or (isinstance(other, Expr)
-            and self.op == other.op and self.args == other.args)
+        """x and y are equal iff their ops and args are equal.  Since Exprs
+        are interned, that is the case iff they are the same object."""
+        return other is self
 
     def __ne__(self, other):
-        return not self.__eq__(other)
+        return other is not self
 
     def __hash__(self):
-        "Need a hash method so Exprs can live in dicts."
-        return hash(self.op) ^ hash(tuple(self.args))
+        "The hash is computed once, when the Expr is built."
+        return self._hash
+
+    def __reduce__(self):
+        "Pickle by op and args, so unpickling interns the Expr again."
+        return (Expr, (self.op,) + self.args)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
 
     # See http://www.python.org/doc/current/lib/module-operator.html
     # Not implemented: not, abs, pos, concat, contains, *item, *slice
@@ -215,9 +694,15 @@ class Expr:
     def __xor__(self, other):    return Expr('^',  self, other)
     def __mod__(self, other):    return Expr('<=>',  self, other)
 
+## The intern table for Expr: maps (op, args) to the unique live Expr.
+_expr_table = weakref.WeakValueDictionary()
+
+## Operators, which Expr need not try to read as numbers.
+_expr_ops = frozenset(['~', '&', '|', '>>', '<<', '<=>', '^', '+', '-', '*',
+                       '/', '**', '%', '<', '>', '<=', '>='])
 
 
-def expr(s):
+def expr(s, logic_precedence=False):
     """Create an Expr representing a logic expression by parsing the input
     string. Symbols and numbers are automatically converted to Exprs.
     In addition you can use alternative spellings of these operators:
@@ -227,20 +712,202 @@ def expr(s):
       'x =/= y'   parses as   (x ^ y)     # Logical disequality (xor)
     But BE CAREFUL; precedence of implication is wrong. expr('P & Q ==> R & S')
     is ((P & (Q >> R)) & S); so you must use expr('(P & Q) ==> (R & S)').
+    The operators get the precedence of the Python operators they stand for,
+    for compatibility with older versions of this function, which rewrote
+    the string and passed it to eval.  With logic_precedence=True they get
+    the usual logical precedence instead: ~ binds tightest, then &, |,
+    implication (==>, <==, right associative), and finally <=> and =/=.
     >>> expr('P <=> Q(1)')
     (P <=> Q(1))
     >>> expr('P & Q | ~R(x, F(x))')
     ((P & Q) | ~R(x, F(x)))
+    >>> expr('P & Q ==> R & S', logic_precedence=True)
+    ((P & Q) >> (R & S))
+    >>> expr('A ==> B ==> C <=> D', logic_precedence=True)
+    ((A >> (B >> C)) <=> D)
+    >>> expr(u'P & Q') is expr('P & Q')
+    True
+
+    Parsed strings are kept in an LRU cache (expr.cache), since Exprs are
+    immutable and the same sentences tend to be parsed over and over.
     """
+    if isinstance(s, unicode): s = s.encode('utf-8') ## Symbols are strs
+    if isinstance(s, str):
+        key = (s, logic_precedence)
+        result = expr.cache.get(key)
+        if result is None:
+            result = expr.cache[key] = ExprParser(s, logic_precedence).parse()
+        return result
     if isinstance(s, Expr): return s
     if isnumber(s): return Expr(s)
-    ## Replace the alternative spellings of operators with canonical spellings
-    s = s.replace('==>', '>>').replace('<==', '<<')
-    s = s.replace('<=>', '%').replace('=/=', '^')
-    ## Replace a symbol or number, such as 'P' with 'Expr("P")'
-    s = re.sub(r'([a-zA-Z0-9_.]+)', r'Expr("\1")', s)
-    ## Now eval the string.  (A security hole; do not use with an adversary.)
-    return eval(s, {'Expr':Expr})
+    raise TypeError("can not make an Expr from %r" % (s,))
+
+class LRUCache:
+    """A dict-like mapping that holds at most maxsize items, discarding the
+    least recently used one when full.  Counts its hits and misses.
+    >>> c = LRUCache(2)
+    >>> c['a'] = 1; c['b'] = 2; c.get('a'); c['c'] = 3
+    1
+    >>> sorted(c.keys()), c.get('b'), c.hits, c.misses
+    (['a', 'c'], None, 1, 1)
+    """
+
+    ## The items are kept in a circular doubly linked list of
+    ## [prev, next, key, value] links, most recently used last.
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.links = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        self.hits = self.misses = 0
+
+    def get(self, key, default=None):
+        "Return the value for key (marking it as recently used), or default."
+        link = self.links.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        prev, next, _, value = link
+        prev[1], next[0] = next, prev
+        root = self.root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0], link[1] = last, root
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self.links:
+            del self[key]
+        root = self.root
+        last = root[0]
+        last[1] = root[0] = self.links[key] = [last, root, key, value]
+        if len(self.links) > self.maxsize:
+            del self[root[1][2]]
+
+    def __delitem__(self, key):
+        prev, next, _, _ = self.links.pop(key)
+        prev[1], next[0] = next, prev
+
+    def __contains__(self, key):
+        return key in self.links
+
+    def __len__(self):
+        return len(self.links)
+
+    def keys(self):
+        return self.links.keys()
+
+    def clear(self):
+        self.links.clear()
+        self.root[:] = [self.root, self.root, None, None]
+
+expr.cache = LRUCache(10000)
+
+class ExprParser:
+    """A precedence-climbing (Pratt) parser for the strings taken by expr.
+    Each binary operator has a binding power (higher binds tighter) and an
+    associativity; unary ~ and - bind tighter than every binary operator
+    but **, and F(x, y) is a function application."""
+
+    token_re = re.compile(r'\s*(?:(==>|<==|<=>|=/=|\*\*|<<|>>|<=|>=|'
+                          r'[~&|^%+\-*/<>(),])|([A-Za-z0-9_.]+))')
+
+    ## The op each operator token builds an Expr with.
+    canonical = {'==>': '>>', '<==': '<<', '%': '<=>', '=/=': '^'}
+
+    ## (binding power, right associative) for each op, in Python's order ...
+    python_powers = {'<': (1, False), '>': (1, False), '<=': (1, False),
+                     '>=': (1, False), '|': (2, False), '^': (3, False),
+                     '&': (4, False), '<<': (5, False), '>>': (5, False),
+                     '+': (6, False), '-': (6, False), '*': (7, False),
+                     '/': (7, False), '<=>': (7, False), '**': (9, True)}
+    ## ... and in the usual logical order.
+    logic_powers = {'<=>': (1, False), '^': (1, False), '>>': (2, True),
+                    '<<': (2, False), '|': (3, False), '&': (4, False),
+                    '<': (5, False), '>': (5, False), '<=': (5, False),
+                    '>=': (5, False), '+': (6, False), '-': (6, False),
+                    '*': (7, False), '/': (7, False), '**': (9, True)}
+    unary_power = 8
+
+    def __init__(self, s, logic_precedence=False):
+        self.s = s
+        self.powers = if_(logic_precedence, self.logic_powers,
+                          self.python_powers)
+        self.tokens = self.tokenize(s)
+        self.i = 0
+
+    def tokenize(self, s):
+        """Return a list of (kind, text) pairs, where kind is 'op' or 'atom',
+        ending with ('end', '')."""
+        tokens = [if_(op, ('op', op), ('atom', atom))
+                  for op, atom in self.token_re.findall(s)]
+        if sum(len(text) for kind, text in tokens) != len(''.join(s.split())):
+            ## findall skipped something; find out where.
+            pos, s = 0, s.rstrip()
+            while pos < len(s):
+                m = self.token_re.match(s, pos)
+                if not m:
+                    raise ValueError("bad character in expression %r at %d"
+                                     % (s, pos))
+                pos = m.end()
+        tokens.append(('end', ''))
+        return tokens
+
+    def error(self, message):
+        raise ValueError("%s in expression %r" % (message, self.s))
+
+    def parse(self):
+        result = self.expression(0)
+        if self.tokens[self.i][0] != 'end':
+            self.error("unexpected %r" % self.tokens[self.i][1])
+        return result
+
+    def expect(self, text):
+        if self.tokens[self.i][1] != text:
+            self.error("expected %r" % text)
+        self.i += 1
+
+    def expression(self, rbp):
+        "Parse operators that bind tighter than rbp."
+        left = self.prefix()
+        while True:
+            kind, text = self.tokens[self.i]
+            op = self.canonical.get(text, text)
+            if kind != 'op' or op not in self.powers:
+                return left
+            power, right_assoc = self.powers[op]
+            if power <= rbp:
+                return left
+            self.i += 1
+            right = self.expression(if_(right_assoc, power - 1, power))
+            left = Expr(op, left, right)
+
+    def prefix(self):
+        "Parse an atom, a call, a parenthesized expression or a unary op."
+        kind, text = self.tokens[self.i]
+        self.i += 1
+        if kind == 'atom':
+            if self.tokens[self.i][1] != '(':
+                return Expr(text)
+            self.i += 1
+            args = []
+            if self.tokens[self.i][1] != ')':
+                args.append(self.expression(0))
+                while self.tokens[self.i][1] == ',':
+                    self.i += 1
+                    args.append(self.expression(0))
+            self.expect(')')
+            return Expr(text)(*args)
+        elif text == '(':
+            result = self.expression(0)
+            self.expect(')')
+            return result
+        elif text in ('~', '-'):
+            return Expr(text, self.expression(self.unary_power))
+        else:
+            self.error("unexpected %r" % (text or 'end'))
 
 def is_symbol(s):
     "A string s is a symbol if it starts with an alphabetic char."
@@ -315,20 +982,26 @@ A, B, C, D, E, F, G, P, Q, x, y, z  = map(Expr, 'ABCDEFGPQxyz')
 
 def tt_entails(kb, alpha):
     """Does kb entail the sentence alpha? Use truth tables. For propositional
-    kb's and sentences. [Fig. 7.10]
+    kb's and sentences. [Fig. 7.10]  Rather than checking one model at a
+    time, as tt_check_all does, this evaluates kb & ~alpha on blocks of
+    models at once (see tt_model_blocks) and stops at the first block that
+    contains a counter-model.
     >>> tt_entails(expr('P & Q'), expr('Q'))
     True
     """
-    import pdb
-    pdb.set_trace()
+    if isinstance(kb, CNF): kb = kb.to_expr()
+    if isinstance(alpha, CNF): alpha = alpha.to_expr()
     assert not variables(alpha)
-    return tt_check_all(kb, alpha, prop_symbols(kb & alpha), {})
+    for block in tt_model_blocks(kb & ~alpha, prop_symbols(kb & alpha)):
+        return False
+    return True
 
 def tt_check_all(kb, alpha, symbols, model):
-    "Auxiliary routine to implement tt_entails."
+    """Auxiliary routine to implement tt_entails one model at a time, as in
+    the book."""
     if not symbols:
-        if pl_true(kb, model):
-            result = pl_true(alpha, model)
+        if pl_compile(kb)(model):
+            result = pl_compile(alpha)(model)
             assert result in (True, False)
             return result
         else:
@@ -402,13 +1075,188 @@ def pl_true(exp, model={}):
     else:
         raise ValueError, "illegal operator in logic expression" + str(exp)
 
+def pl_compile(exp, symtab=None):
+    """Compile a propositional sentence into a function of a model that
+    computes the same value as pl_true(exp, model), including None for
+    'not obvious'.  With no symtab the model is a dict, as for pl_true;
+    with a SymbolTable it is a list indexed by symbol number holding True,
+    False or None.  Compiled functions are cached per (interned) sentence:
+    in the symtab, or else in an LRU cache of the 10000 latest.
+    >>> f = pl_compile(expr('(A | B) & ~C'))
+    >>> f({A: True, C: False}), f({B: False}), f({C: True})
+    (True, None, False)
+    >>> st = SymbolTable([A, B, C])
+    >>> pl_compile(expr('A <=> C'), st)([None, True, None, True])
+    True
+    """
+    if symtab is None:
+        cache = _pl_compiled
+    else:
+        cache = symtab.compiled
+    f = cache.get(exp)
+    if f is None:
+        f = cache[exp] = _pl_closure(exp, symtab)
+    return f
+
+## A closure holds on to the symbols it looks up, so a weak-keyed table
+## would never let go of a symbol's entry; this one is bounded instead.
+_pl_compiled = LRUCache(10000)
+
+def _pl_closure(exp, symtab):
+    "Build the closure for pl_compile (without caching)."
+    op, args = exp.op, exp.args
+    if exp == TRUE:
+        return lambda model: True
+    elif exp == FALSE:
+        return lambda model: False
+    elif is_prop_symbol(op):
+        if symtab is None:
+            return lambda model: model.get(exp)
+        i = symtab.intern(exp)
+        return lambda model: model[i]
+    elif op == '~':
+        f = _pl_closure(args[0], symtab)
+        def negation(model):
+            p = f(model)
+            if p is None: return None
+            return not p
+        return negation
+    elif op == '|':
+        fs = [_pl_closure(arg, symtab) for arg in args]
+        def disjunction(model):
+            result = False
+            for f in fs:
+                p = f(model)
+                if p is True: return True
+                if p is None: result = None
+            return result
+        return disjunction
+    elif op == '&':
+        fs = [_pl_closure(arg, symtab) for arg in args]
+        def conjunction(model):
+            result = True
+            for f in fs:
+                p = f(model)
+                if p is False: return False
+                if p is None: result = None
+            return result
+        return conjunction
+    p, q = args
+    if op == '>>':
+        return _pl_closure(~p | q, symtab)
+    elif op == '<<':
+        return _pl_closure(p | ~q, symtab)
+    elif op not in ('<=>', '^'):
+        raise ValueError, "illegal operator in logic expression" + str(exp)
+    fp, fq = _pl_closure(p, symtab), _pl_closure(q, symtab)
+    equal = (op == '<=>')
+    def comparison(model):
+        pt = fp(model)
+        if pt is None: return None
+        qt = fq(model)
+        if qt is None: return None
+        return (pt == qt) == equal
+    return comparison
+
+#______________________________________________________________________________
+# Bit-parallel truth tables.  A block of 2**k models is represented by one
+# int per symbol, whose bit j is the value of the symbol in model j.  The
+# value of a sentence on the whole block then takes one bitwise operation per
+# operator, with Python's long ints as arbitrarily wide machine words.
+
+tt_block_bits = 12  ## Symbols enumerated inside each block (4096 models)
+
+def bit_compile(s, symbols):
+    """Compile the propositional sentence s, over the given list of symbols,
+    into a function of (masks, full): masks[i] is the int holding the values
+    of symbols[i] over a block of models, full is the int with every bit of
+    the block set, and the result holds the values of s.
+    >>> f = bit_compile(expr('A >> B'), [A, B])
+    >>> bin(f([0b0101, 0b0011], 0b1111))
+    '0b1011'
+    """
+    index = {TRUE: len(symbols), FALSE: len(symbols) + 1}
+    for i, sym in enumerate(symbols):
+        index[sym] = i
+    code = []
+    def walk(e):
+        if e not in index:
+            if e.op not in ('~', '&', '|', '>>', '<<', '<=>', '^'):
+                raise ValueError("not a propositional sentence: %s" % e)
+            code.append((e.op, [walk(a) for a in e.args]))
+            index[e] = len(symbols) + 1 + len(code)
+        return index[e]
+    result = walk(s)
+
+    def evaluate(masks, full):
+        r = list(masks)
+        r.extend((full, 0))
+        for op, args in code:
+            if op == '~':
+                v = r[args[0]] ^ full
+            elif op == '&':
+                v = full
+                for a in args: v &= r[a]
+            elif op == '|':
+                v = 0
+                for a in args: v |= r[a]
+            elif op == '>>':
+                v = (r[args[0]] ^ full) | r[args[1]]
+            elif op == '<<':
+                v = r[args[0]] | (r[args[1]] ^ full)
+            elif op == '<=>':
+                v = r[args[0]] ^ r[args[1]] ^ full
+            else:
+                v = r[args[0]] ^ r[args[1]]
+            r.append(v)
+        return r[result]
+    return evaluate
+
+def tt_model_blocks(s, symbols=None):
+    """Generate the blocks of the truth table of s that contain models of s.
+    Each is a triple (model, inner, bits): the first len(symbols) - len(inner)
+    symbols have the values in the dict model, and bit j of bits is set iff
+    s holds when each inner[i] has the value of bit i of j."""
+    if symbols is None: symbols = prop_symbols(s)
+    k = min(len(symbols), tt_block_bits)
+    outer, inner = symbols[:len(symbols) - k], symbols[len(symbols) - k:]
+    full = (1 << (1 << k)) - 1
+    masks = []
+    for i in range(k):
+        width = 1 << (i + 1)
+        mask = ((1 << (1 << i)) - 1) << (1 << i)
+        while width < (1 << k):
+            mask |= mask << width
+            width *= 2
+        masks.append(mask)
+    evaluate = bit_compile(s, outer + inner)
+    for values in itertools.product((False, True), repeat=len(outer)):
+        bits = evaluate([if_(v, full, 0) for v in values] + masks, full)
+        if bits:
+            yield dict(zip(outer, values)), inner, bits
+
+def tt_models(s, symbols=None):
+    """Generate all the models of s, as dicts over its symbols.
+    >>> [pretty(m) for m in tt_models(expr('A & (B | C)'), [A, B, C])]
+    ['{A: True, B: True, C: False}', '{A: True, B: False, C: True}', '{A: True, B: True, C: True}']
+    """
+    for model, inner, bits in tt_model_blocks(s, symbols):
+        for j in range(1 << len(inner)):
+            if bits >> j & 1:
+                m = model.copy()
+                for i, sym in enumerate(inner):
+                    m[sym] = bool(j >> i & 1)
+                yield m
+
 #______________________________________________________________________________
 
 ## Convert to Conjunctive Normal Form (CNF)
 
-def to_cnf(s):
+def to_cnf(s, mode='distribute'):
     """Convert a propositional logical sentence s to conjunctive normal form.
     That is, to the form ((A | ~B | ...) & (B | C | ...) & ...) [p. 253]
+    With mode='tseitin', use the definitional conversion of tseitin_cnf,
+    which introduces auxiliary symbols but does not blow up.
     >>> to_cnf("~(B|C)")
     (~B & ~C)
     >>> to_cnf("B <=> (P1|P2)")
@@ -421,10 +1269,117 @@ def to_cnf(s):
     ((D | A | B | C) & (E | A | B | C))
     """
     if isinstance(s, str): s = expr(s)
+    if mode == 'tseitin':
+        return tseitin_cnf(s)
+    elif mode != 'distribute':
+        raise ValueError("unknown CNF mode: %r" % mode)
     s = eliminate_implications(s) # Steps 1, 2 from p. 253
     s = move_not_inwards(s) # Step 3
     return distribute_and_over_or(s) # Step 4
 
+## Definitional (Tseitin) CNF.  Rather than distributing | over &, which can
+## blow up exponentially, give each compound subformula an auxiliary symbol
+## and add clauses that define it.  Following Plaisted and Greenbaum, only
+## the direction of each definition needed by the polarity with which the
+## subformula occurs is added.  The result is not equivalent to s, but it
+## is satisfiable iff s is, and s entails a sentence that mentions no
+## auxiliary symbols iff the result does.  Auxiliary symbols are shared by
+## all sentences: a given subformula gets the same one for as long as some
+## clause still uses it, so converting the same sentence twice (as
+## PropKB.retract does) gives the same clauses.
+
+def tseitin_cnf(s):
+    """Convert s to CNF by introducing auxiliary symbols for subformulas,
+    so the size of the result is linear in the size of s.
+    >>> s = expr('A | (B & C)')
+    >>> len(conjuncts(tseitin_cnf(s))), [is_aux_symbol(x) for x in
+    ...     prop_symbols(tseitin_cnf(s)) if x not in (A, B, C)]
+    (3, [True])
+    >>> tt_entails(tseitin_cnf(s), expr('A | B')), tt_entails(tseitin_cnf(s), B)
+    (True, False)
+    >>> [x.op.startswith('TSEITIN$') for x in prop_symbols(tseitin_cnf(s))
+    ...  if x not in (A, B, C)]
+    [True]
+    """
+    clauses, emitted = [], {}
+
+    def define(e, polarity):
+        """Return a literal for e, first adding the clauses that define it
+        for the given polarity: +1 (the literal implies e), -1 (e implies
+        the literal) or 0 (both)."""
+        op, args = e.op, e.args
+        if op == '~':
+            return negate_literal(define(args[0], -polarity))
+        if op not in ('&', '|', '>>', '<<', '<=>', '^'):
+            return e  ## A symbol, an FOL atom, TRUE or FALSE
+        x = aux_symbol(e)
+        done = emitted.setdefault(e, set())
+        for pol in if_(polarity == 0, (1, -1), (polarity,)):
+            if pol in done:
+                continue
+            done.add(pol)
+            if op == '&':
+                ls = [define(a, pol) for a in args]
+                if pol > 0: clauses.extend([~x, l] for l in ls)
+                else: clauses.append([x] + map(negate_literal, ls))
+            elif op == '|':
+                ls = [define(a, pol) for a in args]
+                if pol > 0: clauses.append([~x] + ls)
+                else: clauses.extend([x, negate_literal(l)] for l in ls)
+            elif op in ('>>', '<<'):
+                a, b = if_(op == '>>', args, args[::-1])
+                la, lb = define(a, -pol), define(b, pol)
+                if pol > 0: clauses.append([~x, negate_literal(la), lb])
+                else: clauses.extend([[x, la], [x, negate_literal(lb)]])
+            else:
+                la, lb = define(args[0], 0), define(args[1], 0)
+                na, nb = negate_literal(la), negate_literal(lb)
+                head = x
+                if pol > 0: head = ~x
+                if (op == '<=>') == (pol > 0):
+                    clauses.extend([[head, na, lb], [head, la, nb]])
+                else:
+                    clauses.extend([[head, la, lb], [head, na, nb]])
+        return x
+
+    for c in conjuncts(s):
+        if c.op == '|':
+            clauses.append([define(d, 1) for d in disjuncts(c)])
+        else:
+            clauses.append([define(c, 1)])
+    return associate('&', [associate('|', c) for c in clauses])
+
+def negate_literal(literal):
+    "Return the complement of a literal (including TRUE and FALSE)."
+    if literal == TRUE: return FALSE
+    if literal == FALSE: return TRUE
+    if literal.op == '~': return literal.args[0]
+    return ~literal
+
+def aux_symbol(e):
+    "Return the auxiliary symbol that stands for subformula e in tseitin_cnf."
+    x = _aux_symbols.get(e)
+    if x is None:
+        ## The $ keeps expr from ever parsing a user's symbol into this one
+        x = _aux_symbols[e] = Expr('TSEITIN$%d' % _aux_numbers.next())
+        _aux_definitions[x] = e
+    return x
+
+## Both tables hold an auxiliary symbol weakly, and its subformula only
+## through it, so the pair is dropped once no clause uses the symbol.
+_aux_symbols = weakref.WeakValueDictionary() ## subformula -> auxiliary symbol
+_aux_definitions = weakref.WeakKeyDictionary() ## auxiliary symbol -> subformula
+_aux_numbers = itertools.count()
+
+def is_aux_symbol(s):
+    "Is s an auxiliary symbol introduced by tseitin_cnf?"
+    return s in _aux_definitions
+
+def hide_aux(model):
+    "Return the model (a dict) without its auxiliary symbols."
+    if not model: return model
+    return dict((s, v) for s, v in model.items() if not is_aux_symbol(s))
+
 def eliminate_implications(s):
     """Change >>, <<, and <=> into &, |, and ~. That is, return an Expr
     that is equivalent to s, but has only &, |, and ~ as logical operators.
@@ -546,21 +1501,16 @@ def disjuncts(s):
 
 #______________________________________________________________________________
 
-def pl_resolution(KB, alpha):
-    "Propositional-logic resolution: say if alpha follows from KB. [Fig. 7.12]"
-    clauses = KB.clauses + conjuncts(to_cnf(~alpha))
-    new = set()
-    while True:
-        n = len(clauses)
-        pairs = [(clauses[i], clauses[j])
-                 for i in range(n) for j in range(i+1, n)]
-        for (ci, cj) in pairs:
-            resolvents = pl_resolve(ci, cj)
-            if FALSE in resolvents: return True
-            new = new.union(set(resolvents))
-        if new.issubset(set(clauses)): return False
-        for c in new:
-            if c not in clauses: clauses.append(c)
+def pl_resolution(KB, alpha, sos=True):
+    """Propositional-logic resolution: say if alpha follows from KB. [Fig. 7.12]
+    KB may also be a CNF.  Rather than resolving every pair of clauses on
+    every round as in the figure, this runs a ResolutionProver; see there.
+    >>> pl_resolution(PropKB(Fig[7,13]), expr('~P21'))
+    True
+    >>> pl_resolution(PropKB(Fig[7,13]), expr('P21'))
+    False
+    """
+    return ResolutionProver(KB, alpha, sos).prove()
 
 def pl_resolve(ci, cj):
     """Return all clauses that can be obtained by resolving clauses ci and cj.
@@ -578,29 +1528,210 @@ def pl_resolve(ci, cj):
                 clauses.append(associate('|', dnew))
     return clauses
 
+class ResolutionProver:
+    """Refute KB & ~alpha by resolution, with clauses as frozensets of ints.
+    This is the given-clause loop: clauses wait in the set of support, the
+    shortest is taken as the given clause, resolved against every clause
+    already processed that contains a complementary literal (found through
+    an index from literal to clauses), and then becomes processed itself;
+    so each pair of clauses is resolved at most once.  Tautologies are
+    deleted, and a new clause is dropped if an active clause subsumes it
+    (forward subsumption), or else deletes the active clauses it subsumes
+    (backward subsumption).  With sos=True only the clauses of ~alpha start
+    in the set of support, and the KB's clauses are never resolved with
+    each other; this is complete as long as the KB itself is satisfiable.
+    After prove(), stats counts the clauses generated, the tautologies, the
+    clauses subsumed forward and backward, and the clauses retained.
+    >>> prover = ResolutionProver(PropKB(Fig[7,13]), expr('~P12'))
+    >>> prover.prove(), prover.stats['given'] > 0
+    (True, True)
+    """
+
+    def __init__(self, KB, alpha, sos=True):
+        if isinstance(KB, CNF):
+            symtab, kb_clauses = KB.symtab, KB.clauses
+        else:
+            symtab = SymbolTable()
+            kb_clauses = compile_clauses(KB.clauses, symtab).clauses
+        goal_clauses = compile_clauses(conjuncts(to_cnf(~expr(alpha))),
+                                       symtab).clauses
+        self.occurs = {}        ## literal -> set of active clauses
+        self.active = set()     ## Clauses neither subsumed nor deleted
+        self.processed = set()  ## Active clauses that may be resolved with
+        self.queue = []         ## Heap of (len, count, clause): the SOS
+        self.counter = itertools.count()
+        self.refuted = False
+        self.stats = dict(generated=0, tautologies=0, forward_subsumed=0,
+                          backward_subsumed=0, retained=0, given=0)
+        for c in kb_clauses:
+            self.add(frozenset(c), not sos)
+        for c in goal_clauses:
+            self.add(frozenset(c), True)
+
+    def prove(self):
+        "Run the given-clause loop; return True if KB & ~alpha is refuted."
+        queue, stats = self.queue, self.stats
+        while queue and not self.refuted:
+            given = heapq.heappop(queue)[2]
+            if given not in self.active: continue  ## Subsumed while waiting
+            stats['given'] += 1
+            self.processed.add(given)
+            resolvents = []
+            for lit in given:
+                for other in self.occurs.get(-lit, ()):
+                    if other in self.processed:
+                        resolvents.append((given | other) - set((lit, -lit)))
+            for c in resolvents:
+                stats['generated'] += 1
+                if some(lambda l: -l in c, c):
+                    stats['tautologies'] += 1
+                elif self.add(c, True):
+                    stats['retained'] += 1
+                if self.refuted: break
+        return self.refuted
+
+    def add(self, c, waiting):
+        """Add clause c, either to the set of support (waiting) or straight
+        to the processed clauses.  Return False if c is subsumed."""
+        if not c:
+            self.refuted = True
+            return True
+        if self.subsumed(c):
+            self.stats['forward_subsumed'] += 1
+            return False
+        ## The active clauses that c subsumes all contain its rarest literal.
+        rarest = min(c, key=lambda l: len(self.occurs.get(l, ())))
+        for d in [d for d in self.occurs.get(rarest, ()) if c < d]:
+            self.remove(d)
+            self.stats['backward_subsumed'] += 1
+        self.active.add(c)
+        for lit in c:
+            self.occurs.setdefault(lit, set()).add(c)
+        if waiting:
+            heapq.heappush(self.queue, (len(c), self.counter.next(), c))
+        else:
+            self.processed.add(c)
+        return True
+
+    def subsumed(self, c):
+        "Is c subsumed by (a subset of, or equal to) some active clause?"
+        for lit in c:
+            for d in self.occurs.get(lit, ()):
+                if len(d) <= len(c) and d <= c:
+                    return True
+        return False
+
+    def remove(self, c):
+        "Delete c from the active clauses and the index."
+        self.active.discard(c)
+        self.processed.discard(c)
+        for lit in c:
+            self.occurs[lit].discard(c)
+
 #______________________________________________________________________________
 
 class PropDefiniteKB(PropKB):
-    "A KB of propositional definite clauses."
+    """A KB of propositional definite clauses.  Each symbol is indexed to
+    the clauses that have it in their premise, so pl_fc_entails runs in time
+    linear in the size of the KB.  With incremental=True the KB also keeps
+    the state of forward chaining between asks, so that after telling new
+    clauses only their consequences are propagated.
+    >>> kb = PropDefiniteKB(incremental=True)
+    >>> for s in ['A', '(A & B) >> C', 'C >> D']: kb.tell(expr(s))
+    >>> kb.ask(expr('D')), kb.inferred == set([A])
+    (False, True)
+    >>> kb.tell(B); kb.ask(expr('D'))
+    {}
+    """
+
+    def __init__(self, sentence=None, incremental=False):
+        self.index = {}     ## symbol -> clauses with the symbol in their premise
+        self.premises = {}  ## clause -> number of conjuncts in its premise
+        self.incremental = incremental
+        self.clauses = []
+        self.reset()
+        PropKB.__init__(self, sentence)
 
     def tell(self, sentence):
         "Add a definite clause to this KB."
         assert is_definite_clause(sentence), "Must be definite clause"
         self.clauses.append(sentence)
+        if sentence in self.premises:
+            return  ## Already indexed
+        if sentence.op == '>>':
+            premise = conjuncts(sentence.args[0])
+            for p in premise:
+                self.index.setdefault(p, []).append(sentence)
+            self.premises[sentence] = len(premise)
+            if self.incremental:
+                self.count[sentence] = len([p for p in premise
+                                            if p not in self.inferred])
+                if self.count[sentence] == 0:
+                    self.agenda.append(sentence.args[1])
+        else:
+            self.premises[sentence] = 0
+            if self.incremental:
+                self.agenda.append(sentence)
+
+    def compile(self, symtab=None):
+        """Return the KB's definite clauses, converted to CNF, compiled to a
+        CNF of integer clauses.
+        >>> kb = PropDefiniteKB()
+        >>> for s in ['A', 'B', '(A & B) >> C']: kb.tell(expr(s))
+        >>> kb.compile().to_expr()
+        (A & B & (C | ~A | ~B))
+        >>> list(kb.ask_many([C, expr('D')]))
+        [{}, False]
+        >>> ppsubst(kb.backbone([C, expr('D')]))
+        {C: True, D: None}
+        """
+        return compile_clauses([c for s in self.clauses
+                                for c in conjuncts(to_cnf(s))], symtab)
 
     def ask_generator(self, query):
         "Yield the empty substitution if KB implies query; else nothing."
-        if pl_fc_entails(self.clauses, query):
+        if self.incremental:
+            entailed = self.propagate(query)
+        else:
+            entailed = pl_fc_entails(self, query)
+        if entailed:
             yield {}
 
     def retract(self, sentence):
         self.clauses.remove(sentence)
+        if sentence in self.clauses:
+            return  ## Another copy is still told
+        del self.premises[sentence]
+        if sentence.op == '>>':
+            for p in conjuncts(sentence.args[0]):
+                self.index[p].remove(sentence)
+        if self.incremental:
+            self.reset()
 
     def clauses_with_premise(self, p):
-        """Return a list of the clauses in KB that have p in their premise.
-        This could be cached away for O(1) speed, but we'll recompute it."""
-        return [c for c in self.clauses
-                if c.op == '>>' and p in conjuncts(c.args[0])]
+        """Return a list of the clauses in KB that have p in their premise
+        (a clause appears once for each time p occurs in its premise)."""
+        return self.index.get(p, [])
+
+    def reset(self):
+        "Start incremental forward chaining over, from the facts told."
+        self.inferred = set()
+        self.count = dict(self.premises)
+        self.agenda = [c for c in self.clauses if self.premises[c] == 0]
+
+    def propagate(self, q=None):
+        """Run incremental forward chaining until q is inferred or the
+        agenda is empty.  Return True if q has been inferred."""
+        inferred, count, agenda = self.inferred, self.count, self.agenda
+        while agenda and q not in inferred:
+            p = agenda.pop()
+            if p not in inferred:
+                inferred.add(p)
+                for c in self.clauses_with_premise(p):
+                    count[c] -= 1
+                    if count[c] == 0:
+                        agenda.append(c.args[1])
+        return q in inferred
 
 def pl_fc_entails(KB, q):
     """Use forward chaining to see if a PropDefiniteKB entails symbol q.
@@ -608,8 +1739,7 @@ def pl_fc_entails(KB, q):
     >>> pl_fc_entails(Fig[7,15], expr('Q'))
     True
     """
-    count = dict([(c, len(conjuncts(c.args[0]))) for c in KB.clauses
-                                                 if c.op == '>>'])
+    count = dict(KB.premises)
     inferred = DefaultDict(False)
     agenda = [s for s in KB.clauses if is_prop_symbol(s.op)]
     while agenda:
@@ -640,20 +1770,24 @@ def dpll_satisfiable(s):
     rather than True when it succeeds; this is more useful. (2) The
     function find_pure_symbol is passed a list of unknown clauses, rather
     than a list of all clauses and the model; this is more efficient.
+    Auxiliary symbols from tseitin_cnf are left out of the model.
     >>> ppsubst(dpll_satisfiable(A&~B))
     {A: True, B: False}
     >>> dpll_satisfiable(P&~P)
     False
     """
+    if isinstance(s, CNF):
+        values = dpll_int(s.clauses, s.nvars)
+        return values and hide_aux(s.symtab.to_model(values))
     clauses = conjuncts(to_cnf(s))
     symbols = prop_symbols(s)
-    return dpll(clauses, symbols, {})
+    return hide_aux(dpll(clauses, symbols, {}))
 
 def dpll(clauses, symbols, model):
     "See if the clauses are true in a partial model."
     unknown_clauses = [] ## clauses with an unknown truth value
     for c in clauses:
-        val =  pl_true(c, model)
+        val = pl_compile(c)(model)
         if val == False:
             return False
         if val != True:
@@ -730,27 +1864,1507 @@ def inspect_literal(literal):
     else:
         return literal, True
 
+#______________________________________________________________________________
+# Compiled clauses.  Proposition symbols are numbered 1, 2, ..., n; the
+# literal P is then the int +i and ~P is -i, and a clause is a tuple of such
+# ints.  This is the convention of the DIMACS CNF file format.
+
+class SymbolTable:
+    """A two-way mapping between proposition symbols and positive ints.
+    >>> st = SymbolTable()
+    >>> st.literal(expr('~P12')), st.literal(expr('W_23')), st.literal(P)
+    (-1, 2, 3)
+    >>> st.to_literal(-2)
+    ~W_23
+    >>> st.clause(expr('B11 | ~P12 | B11'))
+    (4, -1)
+    """
+
+    def __init__(self, symbols=()):
+        self.number = {}       ## symbol -> int
+        self.symbols = [None]  ## int -> symbol; there is no variable 0
+        self.compiled = {}     ## sentence -> pl_compile function over ints
+        for s in symbols:
+            self.intern(s)
+
+    def __len__(self):
+        return len(self.symbols) - 1
+
+    def intern(self, symbol):
+        "Return the int for symbol, numbering it first if it is new."
+        n = self.number.get(symbol)
+        if n is None:
+            n = self.number[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+        return n
+
+    def literal(self, literal):
+        """The signed int for a literal such as P or ~P.  Anything else is a
+        ValueError; convert sentences with to_cnf first.
+        >>> SymbolTable().literal(expr('A >> B'))
+        Traceback (most recent call last):
+        ...
+        ValueError: not a propositional literal: (A >> B)
+        """
+        sym, positive = inspect_literal(literal)
+        if not (isinstance(sym, Expr) and is_prop_symbol(sym.op)
+                and not sym.args):
+            raise ValueError("not a propositional literal: %s" % literal)
+        n = self.intern(sym)
+        return if_(positive, n, -n)
+
+    def to_literal(self, n):
+        "The Expr literal for the signed int n."
+        if n > 0: return self.symbols[n]
+        else: return ~self.symbols[-n]
+
+    def clause(self, clause):
+        """Compile a disjunction of literals to a tuple of ints, dropping
+        repeated and FALSE literals.  Return None if the clause contains TRUE
+        or a complementary pair, and so can be dropped altogether."""
+        result = []
+        for lit in disjuncts(clause):
+            if lit in (TRUE, ~FALSE): return None
+            if lit in (FALSE, ~TRUE): continue
+            n = self.literal(lit)
+            if -n in result: return None
+            if n not in result:
+                result.append(n)
+        return tuple(result)
+
+    def to_clause(self, clause):
+        "The Expr disjunction for a tuple of ints."
+        return associate('|', [self.to_literal(n) for n in clause])
+
+    def to_model(self, values):
+        """Turn a sequence indexed by variable number, holding True, False or
+        None, into a model dict on symbols (leaving out the None entries)."""
+        return dict((self.symbols[v], values[v])
+                    for v in range(1, min(len(values), len(self.symbols)))
+                    if values[v] is not None)
+
+class CNF:
+    """A conjunction of clauses compiled to tuples of signed ints.  Every
+    solver in this module also accepts a CNF wherever it takes a sentence.
+    >>> cnf = CNF(Fig[7,13])
+    >>> cnf.clauses
+    [(-1, 2), (-3, 2), (1, 3, -2), (-2,)]
+    >>> cnf.to_expr()
+    ((~P12 | B11) & (~P21 | B11) & (P12 | P21 | ~B11) & ~B11)
+    """
+
+    def __init__(self, sentence=None, symtab=None):
+        if symtab is None: symtab = SymbolTable()
+        self.symtab = symtab
+        self.clauses = []
+        if sentence is not None:
+            self.tell(sentence)
+
+    def __len__(self):
+        return len(self.clauses)
+
+    @property
+    def nvars(self):
+        return len(self.symtab)
+
+    def tell(self, sentence):
+        "Convert the sentence to CNF and add its clauses."
+        for c in conjuncts(to_cnf(sentence)):
+            self.add_clause(self.symtab.clause(c))
+
+    def add_clause(self, clause):
+        "Add a clause given as a sequence of ints (None is ignored)."
+        if clause is not None:
+            self.clauses.append(tuple(clause))
+
+    def to_expr(self):
+        "The sentence this CNF stands for."
+        return associate('&', [self.symtab.to_clause(c) for c in self.clauses])
+
+def compile_clauses(clauses, symtab=None):
+    """Compile a list of Expr clauses (as in PropKB.clauses) into a CNF.
+    >>> compile_clauses([A | ~B, B]).clauses
+    [(1, -2), (2,)]
+    """
+    cnf = CNF(symtab=symtab)
+    for c in clauses:
+        cnf.add_clause(cnf.symtab.clause(c))
+    return cnf
+
+def as_cnf(s):
+    "Coerce a sentence, string or CNF to a CNF."
+    if isinstance(s, CNF): return s
+    return CNF(expr(s))
+
+## DIMACS CNF format: 'p cnf <nvars> <nclauses>', then clauses as ints, each
+## terminated by 0.  On output we also record the symbol names as comment
+## lines 'c <int> <symbol>', which parse_dimacs reads back if present.
+
+def parse_dimacs(text):
+    """Parse DIMACS CNF text into a CNF.  Variables without a name comment
+    are given the symbols X1, X2, ...
+    >>> cnf = parse_dimacs('c tiny\\np cnf 3 2\\n1 -3 0\\n2 3 -1 0\\n')
+    >>> cnf.clauses, cnf.to_expr()
+    ([(1, -3), (2, 3, -1)], ((X1 | ~X3) & (X2 | X3 | ~X1)))
+    """
+    names, nvars, clauses, current = {}, 0, [], []
+    for line in text.splitlines():
+        tokens = line.split()
+        if not tokens: continue
+        if tokens[0] == 'c':
+            if (len(tokens) == 3 and tokens[1].isdigit()
+                and is_prop_symbol(tokens[2])):
+                names[int(tokens[1])] = tokens[2]
+        elif tokens[0] == 'p':
+            if len(tokens) != 4 or tokens[1] != 'cnf':
+                raise ValueError("bad DIMACS problem line: %r" % line)
+            nvars = int(tokens[2])
+        elif tokens[0] == '%':
+            break  ## The end marker in the SATLIB benchmark files
+        else:
+            for n in map(int, tokens):
+                if n == 0:
+                    clauses.append(tuple(current))
+                    current = []
+                else:
+                    current.append(n)
+                    nvars = max(nvars, abs(n))
+    if current:
+        clauses.append(tuple(current))
+    symtab = SymbolTable(Expr(names.get(v, 'X%d' % v))
+                         for v in range(1, nvars + 1))
+    if len(symtab) != nvars:
+        raise ValueError("duplicate symbol names in DIMACS comments")
+    cnf = CNF(symtab=symtab)
+    cnf.clauses = clauses
+    return cnf
+
+def to_dimacs(cnf):
+    """Return the DIMACS CNF text for a CNF (or a sentence).
+    >>> print to_dimacs(A & (~B | C)),
+    c 1 A
+    c 2 B
+    c 3 C
+    p cnf 3 2
+    1 0
+    -2 3 0
+    """
+    cnf = as_cnf(cnf)
+    lines = ['c %d %s' % (v, cnf.symtab.symbols[v])
+             for v in range(1, cnf.nvars + 1)]
+    lines.append('p cnf %d %d' % (cnf.nvars, len(cnf.clauses)))
+    lines.extend(' '.join(map(str, c + (0,))) for c in cnf.clauses)
+    return '\n'.join(lines) + '\n'
+
+def read_dimacs(filename):
+    "Read a CNF from a DIMACS file."
+    f = open(filename)
+    try: return parse_dimacs(f.read())
+    finally: f.close()
+
+def write_dimacs(cnf, filename):
+    "Write a CNF (or a sentence) to a DIMACS file."
+    f = open(filename, 'w')
+    try: f.write(to_dimacs(cnf))
+    finally: f.close()
+
+def dpll_int(clauses, nvars):
+    """DPLL on integer clauses.  Return a list indexed by variable number
+    holding True or False (entry 0 is unused), or False if unsatisfiable.
+    >>> dpll_int([(1, 2), (-1,), (-2, 3)], 3)
+    [None, False, True, True]
+    >>> dpll_int([(1,), (-1,)], 1)
+    False
+    """
+    value = [None] * (nvars + 1)
+    trail = []
+
+    def assign(lit):
+        value[abs(lit)] = lit > 0
+        trail.append(abs(lit))
+
+    def undo(mark):
+        while len(trail) > mark:
+            value[trail.pop()] = None
+
+    def propagate():
+        "Assign the units until fixpoint; return False on a conflict."
+        changed = True
+        while changed:
+            changed = False
+            for c in clauses:
+                unit, n = None, 0
+                for lit in c:
+                    v = value[abs(lit)]
+                    if v is None:
+                        unit, n = lit, n + 1
+                    elif v == (lit > 0):
+                        break
+                else:
+                    if n == 0: return False
+                    if n == 1:
+                        assign(unit)
+                        changed = True
+        return True
+
+    def search():
+        mark = len(trail)
+        if propagate():
+            free = find_if(lambda v: value[v] is None, range(1, nvars + 1))
+            if free is None:
+                return True
+            decision = len(trail)
+            for lit in (free, -free):
+                assign(lit)
+                if search(): return True
+                undo(decision)
+        undo(mark)
+        return False
+
+    if search():
+        return value
+    return False
+
+#______________________________________________________________________________
+# Conflict-driven clause learning (CDCL) on integer clauses.
+
+class CDCLSolver:
+    """An incremental CDCL SAT solver over clauses of signed ints.  It uses
+    two watched literals for unit propagation, learns first-UIP clauses,
+    branches on VSIDS activity with phase saving, restarts on the Luby
+    sequence and periodically deletes the less useful learned clauses.
+    Clauses may be added between calls to solve, and solve takes a list
+    of assumption literals that hold for that call only; learned clauses
+    are kept across calls.
+    >>> solver = CDCLSolver([(1, 2), (-1, 2), (-2, 3)])
+    >>> solver.solve(), solver.model[2], solver.model[3]
+    (True, True, True)
+    >>> solver.solve([-3]), solver.solve([1])
+    (False, True)
+    >>> solver.add_clause([-3])
+    False
+    >>> solver.solve()
+    False
+
+    Internally the literal for variable v is coded as 2*v (positive) or
+    2*v+1 (negative), so the code of its negation is code ^ 1.
+    """
+
+    def __init__(self, clauses=(), nvars=0, seed=None, restart_base=100,
+                 var_decay=0.95, random_var_freq=0.0, phase=False):
+        self.nvars = 0
+        self.lv = [-1, -1]      ## literal code -> 1 true, 0 false, -1 unknown
+        self.level = [0]        ## var -> decision level of its assignment
+        self.reason = [None]    ## var -> clause that implied it, or None
+        self.activity = [0.0]   ## var -> VSIDS activity
+        self.saved = [1]        ## var -> sign bit of its last value
+        self.seen = [False]
+        self.watches = [[], []] ## literal code -> clauses watching it
+        self.trail, self.trail_lim, self.qhead = [], [], 0
+        self.clauses, self.learnts = [], []
+        self.clause_activity, self.lbd = {}, {}
+        self.heap = []
+        self.var_inc, self.var_decay = 1.0, var_decay
+        self.cla_inc, self.cla_decay = 1.0, 0.999
+        self.random = random.Random(seed)
+        self.random_var_freq = random_var_freq
+        self.restart_base = restart_base
+        self.default_sign = if_(phase, 0, 1)
+        self.next_reduce, self.reduce_inc = 2000, 300
+        self.ok = True
+        self.model = None
+        self.stats = dict(decisions=0, propagations=0, conflicts=0,
+                          restarts=0, learned=0, deleted=0)
+        self.ensure_vars(nvars)
+        for c in clauses:
+            self.add_clause(c)
+
+    def ensure_vars(self, n):
+        "Make sure the variables 1..n exist."
+        while self.nvars < n:
+            self.nvars += 1
+            self.lv.extend((-1, -1))
+            self.level.append(0)
+            self.reason.append(None)
+            self.activity.append(0.0)
+            self.saved.append(self.default_sign)
+            self.seen.append(False)
+            self.watches.extend(([], []))
+            heapq.heappush(self.heap, (0.0, self.nvars))
+
+    def new_var(self):
+        "Add a fresh variable and return its number."
+        self.ensure_vars(self.nvars + 1)
+        return self.nvars
+
+    def add_clause(self, clause):
+        """Add a clause of signed ints.  Return False if the clauses are now
+        unsatisfiable at the top level."""
+        if not self.ok: return False
+        self._cancel_until(0)
+        lv, codes = self.lv, []
+        for lit in clause:
+            self.ensure_vars(abs(lit))
+            p = if_(lit > 0, 2 * lit, -2 * lit + 1)
+            if lv[p] == 1 or p ^ 1 in codes:
+                return True   ## Satisfied at the top level, or a tautology
+            if lv[p] == -1 and p not in codes:
+                codes.append(p)
+        if not codes:
+            self.ok = False
+        elif len(codes) == 1:
+            self._enqueue(codes[0], None)
+            self.ok = self._propagate() is None
+        else:
+            self.clauses.append(codes)
+            self._watch(codes)
+        return self.ok
+
+    def prefer(self, lit):
+        "Try lit first, the next time the search branches on its variable."
+        self.ensure_vars(abs(lit))
+        self.saved[abs(lit)] = if_(lit > 0, 0, 1)
+
+    def fixed(self, lit):
+        """True or False if the unit clauses, by propagation, fix the value
+        of lit; otherwise None."""
+        p = if_(lit > 0, 2 * lit, -2 * lit + 1)
+        if abs(lit) > self.nvars or self.lv[p] == -1 or self.level[abs(lit)]:
+            return None
+        return self.lv[p] == 1
+
+    def solve(self, assumptions=()):
+        """Search for a model of the clauses in which the assumption
+        literals are true.  On success, return True and leave the model in
+        self.model, a list indexed by variable; otherwise return False."""
+        self.model = None
+        if not self.ok: return False
+        self._cancel_until(0)
+        for lit in assumptions:
+            self.ensure_vars(abs(lit))
+        assumptions = [if_(lit > 0, 2 * lit, -2 * lit + 1)
+                       for lit in assumptions]
+        status, restarts = None, 0
+        while status is None:
+            status = self._search(luby(restarts) * self.restart_base,
+                                  assumptions)
+            if status is None:
+                restarts += 1
+                self.stats['restarts'] += 1
+        if status:
+            lv = self.lv
+            self.model = [None] + [lv[2 * v] == 1
+                                   for v in range(1, self.nvars + 1)]
+        self._cancel_until(0)
+        return status
+
+    def _search(self, budget, assumptions):
+        "Search until a result, or return None after budget conflicts."
+        stats, conflicts = self.stats, 0
+        lv, trail_lim = self.lv, self.trail_lim
+        while True:
+            confl = self._propagate()
+            if confl is not None:
+                conflicts += 1
+                stats['conflicts'] += 1
+                if not trail_lim:
+                    self.ok = False
+                    return False
+                learnt, level, lbd = self._analyze(confl)
+                self._cancel_until(level)
+                if len(learnt) == 1:
+                    self._enqueue(learnt[0], None)
+                else:
+                    self.learnts.append(learnt)
+                    self._watch(learnt)
+                    self.clause_activity[id(learnt)] = self.cla_inc
+                    self.lbd[id(learnt)] = lbd
+                    self._enqueue(learnt[0], learnt)
+                stats['learned'] += 1
+                self.var_inc /= self.var_decay
+                self.cla_inc /= self.cla_decay
+                continue
+            if conflicts >= budget:
+                self._cancel_until(0)
+                return None
+            if stats['conflicts'] >= self.next_reduce:
+                self.next_reduce += 2000 + self.reduce_inc
+                self.reduce_inc += 300
+                self._reduce_db()
+            next = None
+            while len(trail_lim) < len(assumptions):
+                p = assumptions[len(trail_lim)]
+                if lv[p] == 1:
+                    trail_lim.append(len(self.trail)) ## A dummy level
+                elif lv[p] == 0:
+                    return False   ## The assumptions are inconsistent
+                else:
+                    next = p
+                    break
+            if next is None:
+                v = self._pick_branch()
+                if v is None:
+                    return True
+                next = 2 * v + self.saved[v]
+                stats['decisions'] += 1
+            trail_lim.append(len(self.trail))
+            self._enqueue(next, None)
+
+    def _watch(self, c):
+        self.watches[c[0]].append(c)
+        self.watches[c[1]].append(c)
+
+    def _enqueue(self, p, reason):
+        v = p >> 1
+        self.lv[p], self.lv[p ^ 1] = 1, 0
+        self.level[v] = len(self.trail_lim)
+        self.reason[v] = reason
+        self.trail.append(p)
+
+    def _propagate(self):
+        """Propagate the assignments on the trail; return a conflicting
+        clause, or None.  A clause c watches c[0] and c[1], and is visited
+        when one of them becomes false; the implied literal of a reason
+        clause is always c[0]."""
+        lv, watches, trail = self.lv, self.watches, self.trail
+        level, reason = self.level, self.reason
+        qhead = start = self.qhead
+        confl = None
+        while qhead < len(trail) and confl is None:
+            false_lit = trail[qhead] ^ 1
+            qhead += 1
+            ws = watches[false_lit]
+            i = j = 0
+            n = len(ws)
+            while i < n:
+                c = ws[i]
+                i += 1
+                if c[0] == false_lit:
+                    c[0], c[1] = c[1], false_lit
+                first = c[0]
+                if lv[first] == 1:
+                    ws[j] = c
+                    j += 1
+                    continue
+                for k in xrange(2, len(c)):
+                    if lv[c[k]] != 0:
+                        c[1], c[k] = c[k], false_lit
+                        watches[c[1]].append(c)
+                        break
+                else:
+                    ws[j] = c
+                    j += 1
+                    if lv[first] == 0:
+                        confl = c
+                        while i < n:
+                            ws[j] = ws[i]
+                            j += 1
+                            i += 1
+                    else:
+                        lv[first], lv[first ^ 1] = 1, 0
+                        level[first >> 1] = len(self.trail_lim)
+                        reason[first >> 1] = c
+                        trail.append(first)
+            del ws[j:]
+        self.stats['propagations'] += qhead - start
+        self.qhead = if_(confl is None, qhead, len(trail))
+        return confl
+
+    def _analyze(self, confl):
+        """Derive the first-UIP clause from a conflict.  Return the clause
+        (asserting literal first, a literal of the backjump level second),
+        the backjump level and the number of distinct levels (LBD)."""
+        seen, level, reason, trail = self.seen, self.level, self.reason, self.trail
+        current = len(self.trail_lim)
+        learnt, path, p, index = [None], 0, None, len(trail) - 1
+        while True:
+            if id(confl) in self.clause_activity:
+                self._bump_clause(confl)
+            for q in confl[if_(p is None, 0, 1):]:
+                v = q >> 1
+                if not seen[v] and level[v] > 0:
+                    seen[v] = True
+                    self._bump_var(v)
+                    if level[v] >= current:
+                        path += 1
+                    else:
+                        learnt.append(q)
+            while not seen[trail[index] >> 1]:
+                index -= 1
+            p = trail[index]
+            index -= 1
+            confl = reason[p >> 1]
+            seen[p >> 1] = False
+            path -= 1
+            if path == 0:
+                break
+        learnt[0] = p ^ 1
+        ## Drop the literals that are implied by the others.
+        levels = set(level[q >> 1] for q in learnt[1:])
+        marked = [q >> 1 for q in learnt[1:]]
+        kept = learnt[:1]
+        for q in learnt[1:]:
+            if reason[q >> 1] is None or not self._redundant(q, levels, marked):
+                kept.append(q)
+        for v in marked:
+            seen[v] = False
+        learnt = kept
+        if len(learnt) == 1:
+            return learnt, 0, 1
+        best = 1
+        for i in range(2, len(learnt)):
+            if level[learnt[i] >> 1] > level[learnt[best] >> 1]:
+                best = i
+        learnt[1], learnt[best] = learnt[best], learnt[1]
+        lbd = len(set(level[q >> 1] for q in learnt))
+        return learnt, level[learnt[1] >> 1], lbd
+
+    def _redundant(self, q, levels, marked):
+        """Is the literal q of a learned clause implied by the literals
+        marked as seen, following reasons back through the implication
+        graph?  Variables newly found to be implied stay marked (they are
+        appended to marked) so later checks can reuse the work."""
+        seen, level, reason = self.seen, self.level, self.reason
+        stack, top = [q], len(marked)
+        while stack:
+            for x in reason[stack.pop() >> 1][1:]:
+                v = x >> 1
+                if not seen[v] and level[v] > 0:
+                    if reason[v] is not None and level[v] in levels:
+                        seen[v] = True
+                        marked.append(v)
+                        stack.append(x)
+                    else:
+                        for u in marked[top:]:
+                            seen[u] = False
+                        del marked[top:]
+                        return False
+        return True
+
+    def _cancel_until(self, target):
+        "Undo all assignments above decision level target."
+        if len(self.trail_lim) > target:
+            lv, saved, reason, activity = self.lv, self.saved, self.reason, self.activity
+            lim = self.trail_lim[target]
+            for p in self.trail[lim:]:
+                v = p >> 1
+                lv[p] = lv[p ^ 1] = -1
+                reason[v] = None
+                saved[v] = p & 1
+                heapq.heappush(self.heap, (-activity[v], v))
+            del self.trail[lim:]
+            del self.trail_lim[target:]
+            self.qhead = lim
+
+    def _pick_branch(self):
+        "Return the unassigned variable to branch on, or None if there is none."
+        lv, heap, activity = self.lv, self.heap, self.activity
+        if self.random_var_freq and self.random.random() < self.random_var_freq:
+            v = self.random.randint(1, self.nvars)
+            if lv[2 * v] == -1:
+                return v
+        if len(heap) > 4 * self.nvars + 100:
+            self._rebuild_heap()
+        while heap:
+            act, v = heapq.heappop(heap)
+            if lv[2 * v] == -1 and -act == activity[v]:
+                return v
+        return None
+
+    def _rebuild_heap(self):
+        lv, activity = self.lv, self.activity
+        self.heap = [(-activity[v], v) for v in range(1, self.nvars + 1)
+                     if lv[2 * v] == -1]
+        heapq.heapify(self.heap)
+
+    def _bump_var(self, v):
+        self.activity[v] += self.var_inc
+        if self.activity[v] > 1e100:
+            self.activity = [a * 1e-100 for a in self.activity]
+            self.var_inc *= 1e-100
+            self._rebuild_heap()
+        elif self.lv[2 * v] == -1:
+            heapq.heappush(self.heap, (-self.activity[v], v))
+
+    def _bump_clause(self, c):
+        act = self.clause_activity
+        act[id(c)] += self.cla_inc
+        if act[id(c)] > 1e20:
+            for k in act:
+                act[k] *= 1e-20
+            self.cla_inc *= 1e-20
+
+    def _reduce_db(self):
+        """Delete about half of the learned clauses, preferring those with
+        many distinct levels and low activity.  Binary clauses, clauses with
+        LBD of 2 or less and current reasons are kept."""
+        lv, reason, act, lbd = self.lv, self.reason, self.clause_activity, self.lbd
+        self.learnts.sort(key=lambda c: (-lbd[id(c)], act[id(c)]))
+        half = len(self.learnts) // 2
+        kept, dead = [], set()
+        for i, c in enumerate(self.learnts):
+            locked = lv[c[0]] == 1 and reason[c[0] >> 1] is c
+            if i < half and len(c) > 2 and lbd[id(c)] > 2 and not locked:
+                dead.add(id(c))
+            else:
+                kept.append(c)
+        if dead:
+            for ws in self.watches:
+                ws[:] = [c for c in ws if id(c) not in dead]
+            for k in dead:
+                del act[k], lbd[k]
+        self.learnts = kept
+        self.stats['deleted'] += len(dead)
+
+def luby(i):
+    """The i'th element (from 0) of the Luby restart sequence.
+    >>> [luby(i) for i in range(15)]
+    [1, 1, 2, 1, 1, 2, 4, 1, 1, 2, 1, 1, 2, 4, 8]
+    """
+    size, seq = 1, 0
+    while size < i + 1:
+        seq += 1
+        size = 2 * size + 1
+    while size - 1 != i:
+        size = (size - 1) >> 1
+        seq -= 1
+        i = i % size
+    return 2 ** seq
+
+def cdcl_satisfiable(s):
+    """Check satisfiability of a propositional sentence (or CNF) with the
+    CDCL solver.  Like dpll_satisfiable, return a model or False, so it can
+    be passed as the SAT_solver of SAT_plan.
+    >>> ppsubst(cdcl_satisfiable(A&~B))
+    {A: True, B: False}
+    >>> cdcl_satisfiable(P&~P)
+    False
+    """
+    cnf = as_cnf(s)
+    solver = CDCLSolver(cnf.clauses, cnf.nvars)
+    if solver.solve():
+        return hide_aux(cnf.symtab.to_model(solver.model))
+    return False
+
 #______________________________________________________________________________
 # Walk-SAT [Fig. 7.18]
 
 def WalkSAT(clauses, p=0.5, max_flips=10000):
-    ## model is a random assignment of true/false to the symbols in clauses
-    ## See ~/aima1e/print1/manual/knowledge+logic-answers.tex ???
-    model = dict([(s, random.choice([True, False]))
-                 for s in prop_symbols(clauses)])
-    for i in range(max_flips):
-        satisfied, unsatisfied = [], []
-        for clause in clauses:
-            if_(pl_true(clause, model), satisfied, unsatisfied).append(clause)
-        if not unsatisfied: ## if model satisfies all the clauses
-            return model
-        clause = random.choice(unsatisfied)
-        if probability(p):
-            sym = random.choice(prop_symbols(clause))
+    """Search for a model of the clauses (a list of sentences, which are
+    converted to CNF, or a CNF) by flipping symbols: each flip picks a
+    false clause, and flips a random one of its symbols with probability
+    p, or else the one that makes the most clauses true.  Return the
+    model, or None if none was found in max_flips flips.  The work is
+    done by walksat_int.
+    >>> ppsubst(WalkSAT([A | B, ~A, B | ~C, C]))
+    {A: False, B: True, C: True}
+    >>> ppsubst(WalkSAT([expr('A >> B'), A]))
+    {A: True, B: True}
+    """
+    if not isinstance(clauses, CNF):
+        clauses = CNF(associate('&', clauses))
+    values = walksat_int(clauses.clauses, clauses.nvars, p, max_flips)
+    if values is None:
+        return None
+    return clauses.symtab.to_model(values)
+
+def walksat_satisfiable(s, max_flips=100000, method='walksat'):
+    """Like cdcl_satisfiable, but with walksat_int; so it returns False if
+    it finds no model in max_flips flips, even if s is satisfiable.
+    >>> ppsubst(walksat_satisfiable(expr('(A | B) & ~B'), method='probsat'))
+    {A: True, B: False}
+    """
+    cnf = as_cnf(s)
+    values = walksat_int(cnf.clauses, cnf.nvars, max_flips=max_flips,
+                         method=method)
+    if values is None:
+        return False
+    return hide_aux(cnf.symtab.to_model(values))
+
+def walksat_int(clauses, nvars, p=0.5, max_flips=100000, method='walksat',
+                cb=2.38, eps=1.0, values=None):
+    """Local search on integer clauses, starting from values (a list indexed
+    by variable, entry 0 unused) or a random assignment.  Return a list of
+    values that satisfies the clauses, with None in entry 0 as dpll_int
+    has, or None if none was found in max_flips flips.  With method='walksat' the variable flipped in a
+    random false clause is a random one with probability p, and otherwise
+    the one with the best make - break (the number of false clauses it
+    would make true, less the number of true clauses it would make false).
+    With method='probsat' it is chosen with probability proportional to
+    (eps + break)**-cb.  Rather than re-evaluating the clauses on each
+    flip, this keeps each clause's number of true literals, the XOR of its
+    true variables (which is its one true variable, when there is one),
+    the make and break counts of each variable, and the list of false
+    clauses, and updates them for the clauses of the variable flipped.
+    >>> walksat_int([(1, 2), (-1,), (-2, 3)], 3)
+    [None, False, True, True]
+    """
+    if values is None:
+        values = [None] + [random.random() < 0.5 for v in range(nvars)]
+    else:
+        values = [None] + [bool(v) for v in values[1:]]
+    ## Drop tautologies and repeated literals, which the XOR would miscount.
+    cs = []
+    for c in clauses:
+        c = tuple(set(c))
+        if not c:
+            return None
+        if not some(lambda lit: -lit in c, c):
+            cs.append(c)
+    clauses = cs
+    nclauses = len(clauses)
+    vars_of = [tuple([abs(lit) for lit in c]) for c in clauses]
+    pos_occurs = [[] for v in range(nvars + 1)]
+    neg_occurs = [[] for v in range(nvars + 1)]
+    num_true, critical = [0] * nclauses, [0] * nclauses
+    make, brk = [0] * (nvars + 1), [0] * (nvars + 1)
+    false, where = [], [-1] * nclauses
+    for i, c in enumerate(clauses):
+        for lit in c:
+            if lit > 0: pos_occurs[lit].append(i)
+            else: neg_occurs[-lit].append(i)
+            if values[abs(lit)] == (lit > 0):
+                num_true[i] += 1
+                critical[i] ^= abs(lit)
+        if num_true[i] == 0:
+            where[i] = len(false)
+            false.append(i)
+            for v in vars_of[i]:
+                make[v] += 1
+        elif num_true[i] == 1:
+            brk[critical[i]] += 1
+    if method == 'probsat':
+        weight = [(eps + b) ** -cb
+                  for b in range(max(map(len, pos_occurs + neg_occurs)) + 1)]
+    elif method != 'walksat':
+        raise ValueError("unknown local search method: %r" % method)
+    probsat = method == 'probsat'
+    rand = random.random
+    for flip in xrange(max_flips):
+        if not false:
+            return values
+        c = vars_of[false[int(rand() * len(false))]]
+        if probsat:
+            ws = [weight[brk[v]] for v in c]
+            r = rand() * sum(ws)
+            for v, w in zip(c, ws):
+                r -= w
+                if r <= 0: break
+        elif rand() < p:
+            v = c[int(rand() * len(c))]
+        else:
+            best = None
+            for u in c:
+                score = make[u] - brk[u]
+                if best is None or score > best:
+                    best, v = score, u
+        ## Flip v, and update the counts of the clauses it occurs in.
+        values[v] = not values[v]
+        if values[v]: now_true, now_false = pos_occurs[v], neg_occurs[v]
+        else: now_true, now_false = neg_occurs[v], pos_occurs[v]
+        for i in now_true:
+            n = num_true[i]
+            num_true[i] = n + 1
+            if n == 0:
+                j, last = where[i], false.pop()
+                if last != i:
+                    false[j] = last
+                    where[last] = j
+                where[i] = -1
+                for u in vars_of[i]:
+                    make[u] -= 1
+                brk[v] += 1
+            elif n == 1:
+                brk[critical[i]] -= 1
+            critical[i] ^= v
+        for i in now_false:
+            n = num_true[i] - 1
+            num_true[i] = n
+            critical[i] ^= v
+            if n == 0:
+                where[i] = len(false)
+                false.append(i)
+                for u in vars_of[i]:
+                    make[u] += 1
+                brk[v] -= 1
+            elif n == 1:
+                brk[critical[i]] += 1
+    if not false:
+        return values
+    return None
+
+#______________________________________________________________________________
+# A parallel portfolio of SAT solvers
+
+portfolio_configs = [
+    dict(solver='cdcl'),
+    dict(solver='cdcl', seed=1, phase=True, random_var_freq=0.02),
+    dict(solver='cdcl', seed=2, var_decay=0.8, restart_base=50),
+    dict(solver='dpll'),
+    dict(solver='walksat', seed=3, method='probsat'),
+    dict(solver='walksat', seed=4, method='walksat'),
+    ]
+
+def portfolio_satisfiable(s, configs=None, processes=None, timeout=None):
+    """Run several solver configurations on s in a pool of processes, and
+    return the answer of the first one to decide it: a model, or False.
+    Each config is a dict with a 'solver' of 'cdcl' (the other keys are
+    CDCLSolver arguments), 'dpll', or 'walksat' (the keys are a seed and
+    walksat_int arguments); a local search that gives up, or a solver
+    that runs out of stack or memory, decides nothing.
+    The clauses are put once in a shared int array, each clause followed
+    by a 0 as in DIMACS, which the workers inherit rather than unpickle;
+    when the answer is in, the pool is terminated.  Return None if no
+    config decides s, or none does within timeout seconds.
+    >>> ppsubst(portfolio_satisfiable(A&~B))
+    {A: True, B: False}
+    >>> portfolio_satisfiable(P&~P, processes=2)
+    False
+    """
+    import multiprocessing, time
+    cnf = as_cnf(s)
+    configs = configs or portfolio_configs
+    flat = []
+    for c in cnf.clauses:
+        flat.extend(c)
+        flat.append(0)
+    shared = multiprocessing.Array('i', flat, lock=False)
+    if processes is None:
+        processes = min(len(configs), multiprocessing.cpu_count())
+    pool = multiprocessing.Pool(processes, portfolio_init,
+                                (shared, cnf.nvars))
+    try:
+        results = pool.imap_unordered(portfolio_worker, configs)
+        if timeout is not None:
+            deadline = time.time() + timeout
+        for i in range(len(configs)):
+            if timeout is not None:
+                result = results.next(max(0, deadline - time.time()))
+            else:
+                result = results.next()
+            if result is False:
+                return False
+            if result is not None:
+                return hide_aux(cnf.symtab.to_model(result))
+    except multiprocessing.TimeoutError:
+        pass
+    finally:
+        pool.terminate()
+        pool.join()
+    return None
+
+_portfolio_problem = None
+
+def portfolio_init(shared, nvars):
+    "Set up a portfolio worker with the clauses in the shared array."
+    global _portfolio_problem
+    clauses, clause = [], []
+    for lit in shared:
+        if lit:
+            clause.append(lit)
+        else:
+            clauses.append(clause)
+            clause = []
+    _portfolio_problem = (clauses, nvars)
+
+def portfolio_worker(config):
+    """Run one config on the worker's clauses.  Return a list of values,
+    False if they are unsatisfiable, or None if the solver gave up, or ran
+    out of stack (as the recursive dpll_int does on deep problems) or
+    memory."""
+    clauses, nvars = _portfolio_problem
+    args = dict(config)
+    solver = args.pop('solver')
+    if solver not in ('cdcl', 'dpll', 'walksat'):
+        raise ValueError("unknown solver: %r" % solver)
+    try:
+        if solver == 'cdcl':
+            cdcl = CDCLSolver(clauses, nvars, **args)
+            if cdcl.solve():
+                return cdcl.model
+            return False
+        elif solver == 'dpll':
+            return dpll_int(clauses, nvars)
+        else:
+            random.seed(args.pop('seed', None))
+            return walksat_int(clauses, nvars, **args)
+    except (RuntimeError, MemoryError):
+        return None
+
+#______________________________________________________________________________
+# Knowledge compilation into reduced ordered binary decision diagrams
+
+class BDD:
+    """A store of reduced ordered BDDs sharing their nodes.  A node is an
+    int: 0 and 1 are the FALSE and TRUE leaves, and any other node n tests
+    variable var[n] (numbered by symtab, which fixes the variable order),
+    going to low[n] if it is false and high[n] if it is true.  No two
+    nodes have the same triple, so equal functions are equal nodes.
+    >>> bdd = BDD()
+    >>> u = bdd.compile(expr('(A | B) & ~C'))
+    >>> bdd.count(u), bdd.size(u), bdd.any_model(u) == {A: True, C: False}
+    (3, 3, True)
+    >>> bdd.compile(expr('A >> B')) == bdd.compile(expr('~B >> ~A'))
+    True
+    """
+
+    def __init__(self, symtab=None):
+        if symtab is None: symtab = SymbolTable()
+        self.symtab = symtab
+        self.var = [infinity, infinity] ## The leaves come after every var
+        self.low, self.high = [0, 1], [0, 1]
+        self.unique = {}  ## (var, low, high) -> node
+        self.cache = {}   ## (f, g, h) -> ite(f, g, h)
+
+    def node(self, v, low, high):
+        "The node for 'if v then high else low'."
+        if low == high:
+            return low
+        key = (v, low, high)
+        n = self.unique.get(key)
+        if n is None:
+            n = self.unique[key] = len(self.var)
+            self.var.append(v)
+            self.low.append(low)
+            self.high.append(high)
+        return n
+
+    def literal(self, lit):
+        "The node for a literal such as P or ~P."
+        n = self.symtab.literal(lit)
+        if n > 0: return self.node(n, 0, 1)
+        else: return self.node(-n, 1, 0)
+
+    def cofactors(self, f, v):
+        if self.var[f] == v:
+            return self.low[f], self.high[f]
+        return f, f
+
+    def ite(self, f, g, h):
+        "The node for 'if f then g else h'."
+        if f == 1 or g == h: return g
+        if f == 0: return h
+        if g == 1 and h == 0: return f
+        key = (f, g, h)
+        n = self.cache.get(key)
+        if n is None:
+            v = min(self.var[f], self.var[g], self.var[h])
+            f0, f1 = self.cofactors(f, v)
+            g0, g1 = self.cofactors(g, v)
+            h0, h1 = self.cofactors(h, v)
+            n = self.cache[key] = self.node(v, self.ite(f0, g0, h0),
+                                            self.ite(f1, g1, h1))
+        return n
+
+    def conjoin(self, f, g): return self.ite(f, g, 0)
+    def disjoin(self, f, g): return self.ite(f, 1, g)
+    def negate(self, f): return self.ite(f, 0, 1)
+
+    def compile(self, s):
+        "The node for a propositional sentence."
+        if s == TRUE: return 1
+        if s == FALSE: return 0
+        if is_prop_symbol(s.op):
+            return self.literal(s)
+        args = [self.compile(arg) for arg in s.args]
+        if s.op == '~':
+            return self.negate(args[0])
+        elif s.op == '&':
+            return reduce(self.conjoin, args, 1)
+        elif s.op == '|':
+            return reduce(self.disjoin, args, 0)
+        a, b = args[0], args[-1]
+        if s.op == '>>':
+            return self.ite(a, b, 1)
+        elif s.op == '<<':
+            return self.ite(b, a, 1)
+        elif s.op == '<=>':
+            return self.ite(a, b, self.negate(b))
+        elif s.op == '^':
+            return self.ite(a, self.negate(b), b)
+        raise ValueError("illegal operator in logic expression: %s" % s)
+
+    def restrict(self, f, v, value, memo=None):
+        "The node for f with variable v set to value; linear in f's size."
+        if memo is None: memo = {}
+        if self.var[f] > v:
+            return f
+        if self.var[f] == v:
+            return if_(value, self.high[f], self.low[f])
+        if f not in memo:
+            memo[f] = self.node(self.var[f],
+                                self.restrict(self.low[f], v, value, memo),
+                                self.restrict(self.high[f], v, value, memo))
+        return memo[f]
+
+    def assign(self, f, v, value, memo=None):
+        """The node for f & (v == value); like restrict, it only rebuilds
+        the nodes of f that test variables before v."""
+        if memo is None: memo = {}
+        if self.var[f] >= v:
+            if self.var[f] == v:
+                f = if_(value, self.high[f], self.low[f])
+            if f == 0:
+                return 0
+            if value: return self.node(v, 0, f)
+            else: return self.node(v, f, 0)
+        if f not in memo:
+            memo[f] = self.node(self.var[f],
+                                self.assign(self.low[f], v, value, memo),
+                                self.assign(self.high[f], v, value, memo))
+        return memo[f]
+
+    def nodes(self, f):
+        "The set of nodes reachable from f, leaves included."
+        seen, stack = set([f]), [f]
+        while stack:
+            n = stack.pop()
+            if n > 1:
+                for m in (self.low[n], self.high[n]):
+                    if m not in seen:
+                        seen.add(m)
+                        stack.append(m)
+        return seen
+
+    def size(self, f):
+        "The number of inner nodes of f."
+        return len(self.nodes(f) - set([0, 1]))
+
+    def count(self, f, nvars=None):
+        """The number of models of f over variables 1 to nvars (by default,
+        every symbol in symtab), in one bottom-up pass over its nodes."""
+        if nvars is None: nvars = len(self.symtab)
+        level = lambda n: min(self.var[n], nvars + 1)
+        counts = {0: 0, 1: 1}
+        for n in sorted(self.nodes(f) - set([0, 1])): ## Children come first
+            lo, hi = self.low[n], self.high[n]
+            counts[n] = (counts[lo] * 2 ** (level(lo) - level(n) - 1) +
+                         counts[hi] * 2 ** (level(hi) - level(n) - 1))
+        return counts[f] * 2 ** (level(f) - 1)
+
+    def any_model(self, f):
+        """A model of f on the variables it tests along one path to the TRUE
+        leaf, or False if f is unsatisfiable."""
+        if f == 0: return False
+        model = {}
+        while f != 1:
+            sym = self.symtab.symbols[self.var[f]]
+            model[sym] = self.high[f] != 0
+            f = if_(model[sym], self.high[f], self.low[f])
+        return model
+
+def bdd_order(sentences):
+    """An order for the symbols of the conjunction of sentences: symbols
+    that are connected through shared sentences are kept together, each
+    group in the order they first appear.  Interleaving independent groups
+    (the pits and the wumpus, say) would multiply their BDD sizes.
+    >>> bdd_order([expr('B11 <=> P12 | P21'), expr('S11 <=> W12'),
+    ...            expr('B12 <=> P13 | P21')])
+    [B11, P12, P21, B12, P13, S11, W12]
+    """
+    symbols, parent = [], {}
+    def find(x):
+        while parent[x] != x:
+            x = parent[x]
+        return x
+    def collect(s, found):
+        if is_prop_symbol(s.op):
+            if s not in found: found.append(s)
         else:
-            ## Flip the symbol in clause that maximizes number of sat. clauses
-            raise NotImplementedError
-        model[sym] = not model[sym]
+            for arg in s.args:
+                collect(arg, found)
+        return found
+    for s in sentences:
+        syms = collect(s, [])
+        for x in syms:
+            if x not in parent:
+                parent[x] = x
+                symbols.append(x)
+        for x in syms[1:]:
+            parent[find(x)] = find(syms[0])
+    groups = collections.OrderedDict()
+    for x in symbols:
+        groups.setdefault(find(x), []).append(x)
+    return [x for group in groups.values() for x in group]
+
+class CompiledKB(KB):
+    """A propositional KB compiled into one BDD, the conjunction of all its
+    sentences.  Compiling can take a while, but afterwards telling a
+    literal (a percept, say) conjoins it in time linear in the BDD's size,
+    and so do asking a conjunction of literals, consistent and
+    count_models.  Other queries are compiled and combined with the BDD.
+    The variable order is that of bdd_order on the first sentence, unless
+    one is given; later symbols go at the end.  save and load_compiled_kb
+    keep the compiled BDD on disk.
+    >>> kb = CompiledKB(Fig[7,13])
+    >>> kb.ask(expr('~P12 & ~P21')), kb.ask(expr('P12 | P21'))
+    ({}, False)
+    >>> kb.count_models(), kb.consistent()
+    (1, True)
+    >>> kb.retract(expr('~B11')); kb.count_models()
+    4
+    >>> kb.ask(expr('X')), kb.count_models()
+    (False, 4)
+    >>> CompiledKB(PropKB(expr('A | B'))).count_models()
+    3
+    """
+
+    def __init__(self, sentence=None, order=None):
+        if isinstance(sentence, PropKB):
+            sentence = associate('&', sentence.clauses)
+        if order is None:
+            order = bdd_order(conjuncts(expr(sentence or TRUE)))
+        self.bdd = BDD(SymbolTable(order))
+        self.sentences = []
+        self.symbols = set()  ## The symbols of the sentences
+        self.root = 1
+        if sentence:
+            self.tell(sentence)
+
+    def tell(self, sentence):
+        "Conjoin the sentence (or the clauses of a PropKB) to the BDD."
+        if isinstance(sentence, PropKB):
+            sentence = associate('&', sentence.clauses)
+        for c in conjuncts(expr(sentence)):
+            self.sentences.append(c)
+            self.symbols.update(prop_symbols(c))
+            sym, positive = inspect_literal(c)
+            if is_prop_symbol(sym.op):
+                v = self.bdd.symtab.intern(sym)
+                self.root = self.bdd.assign(self.root, v, positive)
+            else:
+                self.root = self.bdd.conjoin(self.root, self.bdd.compile(c))
+
+    def ask_generator(self, query):
+        "Yield the empty substitution if KB implies query; else nothing."
+        if self.entails(expr(query)):
+            yield {}
+
+    def entails(self, query):
+        """Does the KB entail the query?  It does a literal l iff the BDD
+        restricted to ~l is FALSE."""
+        for c in conjuncts(query):
+            sym, positive = inspect_literal(c)
+            if is_prop_symbol(sym.op):
+                n = self.bdd.symtab.intern(sym)
+                if self.bdd.restrict(self.root, n, not positive) != 0:
+                    return False
+            elif self.bdd.ite(self.root, self.bdd.compile(c), 1) != 1:
+                return False
+        return True
+
+    def retract(self, sentence):
+        "Remove the sentence's conjuncts, and compile the rest again."
+        for c in conjuncts(expr(sentence)):
+            if c in self.sentences:
+                self.sentences.remove(c)
+        self.symbols = set(s for c in self.sentences for s in prop_symbols(c))
+        self.bdd = BDD(self.bdd.symtab)
+        self.root = self.bdd.compile(associate('&', self.sentences))
+
+    def consistent(self):
+        return self.root != 0
+
+    def count_models(self):
+        """The number of models of the KB over the symbols of its sentences.
+        The BDD counts over every symbol in its table, queries' included,
+        but the root tests none of the others, so each doubles the count."""
+        others = len(self.bdd.symtab) - len(self.symbols)
+        return self.bdd.count(self.root) // 2 ** others
+
+    def save(self, filename):
+        """Write the BDD to a file: the symbols, in order, then the nodes
+        reachable from the root, then the root and the KB's sentences."""
+        bdd, nodes = self.bdd, sorted(self.bdd.nodes(self.root) - set([0, 1]))
+        f = open(filename, 'w')
+        f.write(' '.join(map(str, bdd.symtab.symbols[1:])) + '\n')
+        for n in nodes:
+            f.write('%d %d %d %d\n' % (n, bdd.var[n], bdd.low[n], bdd.high[n]))
+        f.write('root %d\n' % self.root)
+        for s in self.sentences:
+            f.write('%s\n' % s)
+        f.close()
+
+def load_compiled_kb(filename):
+    """Read a CompiledKB written by its save method.  The nodes are renumbered
+    as they are read; since children come before their parents, each one
+    only needs a lookup in the unique table."""
+    f = open(filename)
+    kb = CompiledKB(order=map(expr, f.readline().split()))
+    new = {0: 0, 1: 1}
+    for line in f:
+        if line.startswith('root'):
+            kb.root = new[int(line.split()[1])]
+            break
+        n, v, low, high = map(int, line.split())
+        new[n] = kb.bdd.node(v, new[low], new[high])
+    kb.sentences = [expr(line) for line in f]
+    kb.symbols = set(s for c in kb.sentences for s in prop_symbols(c))
+    f.close()
+    return kb
+
+def compiled_kb(key, sentences, directory=None):
+    """The CompiledKB of sentences(), cached on disk under key: for the
+    wumpus axioms, say, key could be ('wumpus', width, height).  The file
+    is named by a hash of repr(key).  If it is in directory (by default
+    compiled_kb_directory()), load it; else compile the sentences and save
+    them there, to a temporary file that is then renamed, so that no
+    reader ever sees a file half written."""
+    import hashlib, os, tempfile
+    directory = directory or compiled_kb_directory()
+    filename = os.path.join(directory,
+                            'kb_%s.bdd' % hashlib.sha1(repr(key)).hexdigest())
+    if os.path.exists(filename):
+        return load_compiled_kb(filename)
+    kb = CompiledKB(sentences())
+    fd, temp = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    os.close(fd)
+    try:
+        kb.save(temp)
+        os.rename(temp, filename)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+    return kb
+
+def compiled_kb_directory():
+    """The directory where compiled_kb keeps its files by default: one in
+    the system temp directory for this user alone, created if need be.
+    Raise OSError if it is a link, or belongs to another user, or others
+    can get at it, since its files are trusted when they are loaded."""
+    import os, stat, tempfile
+    directory = os.path.join(tempfile.gettempdir(),
+                             'compiled_kb_%d' % os.getuid())
+    try:
+        os.mkdir(directory, 0700)
+    except OSError:
+        pass  ## It exists already (or cannot be made, which lstat reports)
+    st = os.lstat(directory)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid()
+        or st.st_mode & 077):
+        raise OSError("unsafe compiled KB directory: %s" % directory)
+    return directory
+
+#______________________________________________________________________________
+# Weighted model counting
+
+def model_count(clauses, assumptions=(), weights=None):
+    """The number of models, over all their symbols, of clauses (a list of
+    Expr clauses as in PropKB.clauses, a sentence, or a CNF) in which the
+    assumption literals hold.  With weights, a dict {symbol: probability
+    that it is true}, each model counts as the product of the
+    probabilities of its values for those symbols.
+    >>> model_count([A | B, ~B | C])
+    4
+    >>> model_count([A | B, ~B | C], [~A])
+    1
+    >>> model_count([A | B], weights={A: 0.5, B: 0.5})
+    0.75
+    >>> model_count([A | B], weights={C: 0.3})
+    3.0
+    """
+    cnf = clauses_cnf(clauses)
+    lits = [cnf.symtab.literal(lit) for lit in assumptions]
+    counter = ModelCounter(cnf, weights, keep=map(abs, lits))
+    return counter.count(lits)
+
+def marginals(clauses, symbols, assumptions=(), weights=None):
+    """A dict {symbol: probability that it is true} for each of the symbols,
+    given the clauses and assumptions, where the probability of a model is
+    proportional to its weight as in model_count.  All the symbols come
+    out of a single counting pass.  Return None if there are no models.
+    >>> P12, P21 = expr('P12'), expr('P21')
+    >>> probs = marginals(expr('(B11 <=> (P12 | P21)) & B11'), [P12, P21],
+    ...                   weights={P12: 0.2, P21: 0.2})
+    >>> round(probs[P12], 4), round(probs[P21], 4)
+    (0.5556, 0.5556)
+    """
+    cnf = clauses_cnf(clauses)
+    lits = [cnf.symtab.literal(lit) for lit in assumptions]
+    query = [cnf.symtab.intern(s) for s in symbols]
+    counter = ModelCounter(cnf, weights, keep=map(abs, lits), query=query)
+    z, marginal = counter.count_marginals(lits)
+    if not z:
+        return None
+    return dict((s, float(marginal[v]) / z) for s, v in zip(symbols, query))
+
+def clauses_cnf(clauses):
+    "Coerce a list of Expr clauses, a sentence, or a CNF to a CNF."
+    if isinstance(clauses, list):
+        return compile_clauses(clauses)
+    return as_cnf(clauses)
+
+class ModelCounter:
+    """Weighted model counting on the integer clauses of a CNF.  The
+    counter assigns a literal, propagates units, splits the clauses left
+    into components that share no variables and counts each of them on
+    its own, by branching on its most frequent variable; the count of
+    each component is cached, so one that comes up again in another
+    branch (or another call) is not counted again.  Alongside each count
+    it keeps, for each query variable, the weight of the models in which
+    that variable is true, which gives the marginals in the same pass.
+    Beforehand, a variable that is only defined (by clauses saying that
+    it is true iff none of some literals is true, as in B <=> P12 | P21,
+    or a Tseitin definition) and used nowhere else is dropped with its
+    definition, unless it is weighted, a query variable, or in keep:
+    that leaves the count unchanged, and it would otherwise tie
+    unobserved parts of a wumpus world into one big component.
+    >>> cnf = CNF(expr('(A | B) & (C <=> (A & B))'))
+    >>> mc = ModelCounter(cnf)
+    >>> mc.count(), len(mc.eliminated)
+    (3, 1)
+    >>> mc = ModelCounter(cnf, keep=[cnf.symtab.intern(C)])
+    >>> mc.count([cnf.symtab.literal(~C)])
+    2
+    """
+
+    def __init__(self, cnf, weights=None, keep=(), query=()):
+        weights = [(cnf.symtab.intern(sym), p)
+                   for sym, p in (weights or {}).items()]
+        n = max(cnf.nvars, len(cnf.symtab)) ## Weighted symbols may be new
+        self.pos, self.neg = [1] * (n + 1), [1] * (n + 1)
+        for v, p in weights:
+            self.pos[v], self.neg[v] = p, 1 - p
+        self.query = set(query)
+        keep = set(keep) | self.query
+        keep.update(v for v in range(1, n + 1) if self.pos[v] != 1
+                    or self.neg[v] != 1)
+        self.clauses, self.eliminated = self.eliminate_definitions(
+            [tuple(sorted(set(c))) for c in cnf.clauses], keep)
+        self.vars = set(range(1, n + 1)) - set(self.eliminated)
+        self.cache = {}  ## component -> (count, {query var: count})
+
+    def eliminate_definitions(self, clauses, keep):
+        """Drop the variables outside keep whose clauses only define them,
+        and those clauses; return the clauses left and the variables."""
+        clauses = [c for c in collections.OrderedDict.fromkeys(clauses)
+                   if not some(lambda l: -l in c, c)]
+        occurs = collections.defaultdict(list)
+        for c in clauses:
+            for lit in c:
+                occurs[abs(lit)].append(c)
+        eliminated, dropped, changed = [], set(), True
+        while changed:
+            changed = False
+            for v in sorted(occurs):
+                if v in keep or v in eliminated: continue
+                cs = [c for c in occurs[v] if c not in dropped]
+                if cs and self.is_definition(v, cs):
+                    dropped.update(cs)
+                    eliminated.append(v)
+                    changed = True
+        return [c for c in clauses if c not in dropped], eliminated
+
+    def is_definition(self, v, cs):
+        """Do the clauses cs, all those with v, say l <=> ~a1 & ... & ~ak,
+        as the clause (l | a1 | ... | ak) and the clauses (~l | ~ai), for l
+        one of v and ~v?"""
+        for l in (v, -v):
+            long = [c for c in cs if l in c]
+            if len(long) != 1:
+                continue
+            binaries = set(tuple(sorted((-l, -a))) for a in long[0] if a != l)
+            rest = set(c for c in cs if c is not long[0])
+            if (len(rest) == len(cs) - 1 == len(binaries) and rest == binaries):
+                return True
+        return False
+
+    def count(self, assumptions=()):
+        "The weighted count of models in which the assumption ints hold."
+        return self.count_marginals(assumptions)[0]
+
+    def count_marginals(self, assumptions=()):
+        """The weighted count of models in which the assumption ints hold,
+        and a dict {query var: weighted count of those where it is true}."""
+        return self.condition(self.clauses, assumptions, self.vars)
+
+    def condition(self, clauses, lits, scope):
+        """Count the models over the variables in scope of the clauses with
+        the literals lits assigned, and the query marginals."""
+        value, clauses = self.propagate(clauses, lits)
+        if value is None:
+            return 0, {}
+        z, marginal = 1, {}
+        for v, val in value.items():
+            z *= if_(val, self.pos[v], self.neg[v])
+        in_clauses = set(abs(lit) for c in clauses for lit in c)
+        free = [v for v in scope if v not in value and v not in in_clauses]
+        for v in free:
+            z *= self.pos[v] + self.neg[v]
+        parts = [self.component(c) for c in self.components(clauses)]
+        for zc, m in parts:
+            z *= zc
+        if z == 0:
+            return 0, {}
+        for v in self.query.intersection(value):
+            marginal[v] = if_(value[v], z, 0)
+        for v in self.query.intersection(free):
+            marginal[v] = z * self.pos[v] / (self.pos[v] + self.neg[v])
+        for zc, m in parts:
+            for v, zv in m.items():
+                marginal[v] = zv * (z / zc)
+        return z, marginal
+
+    def component(self, clauses):
+        "Count a connected component by branching on its commonest var."
+        key = frozenset(clauses)
+        if key not in self.cache:
+            scope = set(abs(lit) for c in clauses for lit in c)
+            counts = collections.Counter(abs(lit) for c in clauses for lit in c)
+            v = max(sorted(scope), key=counts.__getitem__)
+            z1, m1 = self.condition(clauses, [v], scope)
+            z0, m0 = self.condition(clauses, [-v], scope)
+            marginal = {}
+            for u in set(m1) | set(m0):
+                marginal[u] = m1.get(u, 0) + m0.get(u, 0)
+            self.cache[key] = (z1 + z0, marginal)
+        return self.cache[key]
+
+    def propagate(self, clauses, lits):
+        """Assign the literals and propagate units.  Return the values
+        assigned and the clauses left unsatisfied, or (None, None)."""
+        value, stack = {}, list(lits)
+        while True:
+            while stack:
+                lit = stack.pop()
+                if abs(lit) in value:
+                    if value[abs(lit)] != (lit > 0): return None, None
+                else:
+                    value[abs(lit)] = lit > 0
+            remaining = []
+            for c in clauses:
+                rest = []
+                for lit in c:
+                    val = value.get(abs(lit))
+                    if val is None:
+                        rest.append(lit)
+                    elif val == (lit > 0):
+                        break
+                else:
+                    if not rest:
+                        return None, None
+                    elif len(rest) == 1:
+                        stack.append(rest[0])
+                    else:
+                        remaining.append(tuple(rest))
+            clauses = remaining
+            if not stack:
+                return value, clauses
+
+    def components(self, clauses):
+        "Split the clauses into groups that share no variables."
+        parent = {}
+        def find(x):
+            while parent.setdefault(x, x) != x:
+                x = parent[x]
+            return x
+        for c in clauses:
+            for lit in c[1:]:
+                parent[find(abs(lit))] = find(abs(c[0]))
+        groups = collections.defaultdict(list)
+        for c in clauses:
+            groups[find(abs(c[0]))].append(c)
+        return groups.values()
 
 #______________________________________________________________________________
 
@@ -760,51 +3374,326 @@ class HybridWumpusAgent(agents.Agent):
         unimplemented()
 
 def plan_route(current, goals, allowed):
-    unimplemented()
+    """Plan a shortest route for the agent from current, a pair (square,
+    orientation), to any of the goal squares through the allowed squares,
+    as a list of 'MOVE', 'ROTATE_LEFT' and 'ROTATE_RIGHT' actions; or
+    None if there is none.  Orientations are those of wwagent: 0 faces +x,
+    1 +y, 2 -x and 3 -y, and turning left adds 1.
+    >>> plan_route(((1, 1), 0), [(2, 2)], [(1, 1), (1, 2), (2, 2)])
+    ['ROTATE_LEFT', 'MOVE', 'ROTATE_RIGHT', 'MOVE']
+    """
+    squares = set(allowed)
+    squares.add(current[0])
+    transition = {}
+    for (x, y) in squares:
+        for o, (dx, dy) in enumerate([(1, 0), (0, 1), (-1, 0), (0, -1)]):
+            successors = {'ROTATE_LEFT': ((x, y), (o + 1) % 4),
+                          'ROTATE_RIGHT': ((x, y), (o - 1) % 4)}
+            if (x + dx, y + dy) in squares:
+                successors['MOVE'] = ((x + dx, y + dy), o)
+            transition[(x, y), o] = successors
+    goal_states = [(g, o) for g in goals if g in squares for o in range(4)]
+    return SAT_plan(current, transition, goal_states, len(transition))
 
 #______________________________________________________________________________
 
-def SAT_plan(init, transition, goal, t_max, SAT_solver=dpll_satisfiable):
-    "[Fig. 7.22]"
-    for t in range(t_max):
-        cnf = translate_to_SAT(init, transition, goal, t)
-        model = SAT_solver(cnf)
+def SAT_plan(init, transition, goal, t_max, SAT_solver=None):
+    """Find a shortest plan of at most t_max actions from state init to
+    goal (a state, or a list of states), where transition[s][a] is the
+    state that action a leads to from state s.  [Fig. 7.22]  By default
+    the horizons are tried by one SATPlanner, which extends its encoding
+    and keeps its solver from one horizon to the next; given a SAT_solver,
+    the encoding of each horizon is solved afresh, as in the book.
+    >>> transition = {'A': {'Left': 'A', 'Right': 'B'},
+    ...               'B': {'Left': 'A', 'Right': 'C'},
+    ...               'C': {'Left': 'B', 'Right': 'C'}}
+    >>> SAT_plan('A', transition, 'C', 2)
+    ['Right', 'Right']
+    >>> SAT_plan('A', transition, 'C', 1, SAT_solver=dpll_satisfiable) is None
+    True
+    >>> SAT_plan('C', transition, ['A', 'C'], 3, SAT_solver=cdcl_satisfiable)
+    []
+    """
+    planner = SATPlanner(init, transition, goal)
+    if SAT_solver is None:
+        return planner.plan(t_max)
+    for t in range(t_max + 1):
+        model = SAT_solver(planner.translate_to_SAT(t))
         if model is not False:
-            return extract_solution(model)
+            return planner.extract_solution(model, t)
     return None
 
-def translate_to_SAT(init, transition, goal, t):
-    unimplemented()
+class SATPlanner:
+    """The SATPlan encoding of a deterministic planning problem, extended a
+    time step at a time.  At_i_t says that the state at time t is the i'th
+    one, and Do_j_t that the j'th action is done at time t.  Exactly one
+    action is done at each step; a state and action at t imply the next
+    state, and a state at t+1 and the action at t imply one of the states
+    that action leads to it from, so with one state at time 0 there is one
+    at every t, without any at-most-one clauses over the states.  As in a
+    planning graph, At_i_t only exists for the states that can be reached
+    in exactly t steps (layers[t]); the others are false.  Rather than a
+    unit clause, the goal at horizon t is Goal_t ==> (At_g_t | ...), so
+    plan can assume Goal_t, and keep its solver and learned clauses when
+    it moves on to the next horizon.
+    """
 
-def extract_solution(model):
-    unimplemented()
+    def __init__(self, init, transition, goal):
+        self.transition = transition
+        self.states, self.index = [], {}
+        self.actions, self.action_index = [], {}
+        for s in [init] + list(transition):
+            self.add_state(s)
+            for a, s1 in transition.get(s, {}).items():
+                self.add_state(s1)
+                if a not in self.action_index:
+                    self.action_index[a] = len(self.actions)
+                    self.actions.append(a)
+        if not isinstance(goal, list):
+            goal = [goal]
+        self.goals = [self.index[g] for g in goal if g in self.index]
+        self.cnf = CNF()
+        self.cnf.add_clause([self.at(0, 0)])
+        self.layers = [[0]]
+        self.sizes = [len(self.cnf)]  ## horizon -> number of clauses
+        self.solver, self.fed = None, 0
+
+    def add_state(self, s):
+        if s not in self.index:
+            self.index[s] = len(self.states)
+            self.states.append(s)
+
+    def var(self, name):
+        return self.cnf.symtab.intern(Expr(name))
+
+    def at(self, i, t):
+        return self.var('At_%d_%d' % (i, t))
+
+    def do(self, j, t):
+        return self.var('Do_%d_%d' % (j, t))
+
+    def goal_clause(self, t):
+        layer = set(self.layers[t])
+        return [self.at(i, t) for i in self.goals if i in layer]
+
+    def extend(self):
+        "Add the clauses for the step from the last horizon to the next."
+        t, add = len(self.layers) - 1, self.cnf.add_clause
+        do = [self.do(j, t) for j in range(len(self.actions))]
+        add(do)
+        for j in range(len(do)):
+            for k in range(j + 1, len(do)):
+                add([-do[j], -do[k]])
+        sources = {}  ## (action, state at t+1) -> states at t it follows
+        for i in self.layers[t]:
+            successors = self.transition.get(self.states[i], {})
+            for j, a in enumerate(self.actions):
+                if a in successors:
+                    i1 = self.index[successors[a]]
+                    add([-self.at(i, t), -do[j], self.at(i1, t + 1)])
+                    sources.setdefault((j, i1), []).append(i)
+                else:
+                    add([-self.at(i, t), -do[j]])
+        layer = sorted(set(i1 for (j, i1) in sources))
+        for i1 in layer:
+            for j in range(len(do)):
+                add([-self.at(i1, t + 1), -do[j]] +
+                    [self.at(i, t) for i in sources.get((j, i1), [])])
+        self.layers.append(layer)
+        self.sizes.append(len(self.cnf))
+
+    def translate_to_SAT(self, t):
+        "A CNF whose models are the plans of exactly t steps."
+        while len(self.layers) <= t:
+            self.extend()
+        cnf = CNF(symtab=self.cnf.symtab)
+        cnf.clauses = self.cnf.clauses[:self.sizes[t]]
+        cnf.clauses.append(tuple(self.goal_clause(t)))
+        return cnf
+
+    def extract_solution(self, model, t):
+        "The actions done at times 0 to t-1 in the model."
+        plan = []
+        for u in range(t):
+            for j, a in enumerate(self.actions):
+                if model.get(Expr('Do_%d_%d' % (j, u))):
+                    plan.append(a)
+        return plan
+
+    def plan(self, t_max):
+        """Try horizons 0 to t_max with one CDCLSolver, adding each step's
+        clauses to it as they are needed.  A horizon whose layer holds no
+        goal state is passed over without calling the solver."""
+        if self.solver is None:
+            self.solver = CDCLSolver()
+        for t in range(t_max + 1):
+            while len(self.layers) <= t:
+                self.extend()
+            goal_clause = self.goal_clause(t)
+            if not goal_clause:
+                continue
+            for c in self.cnf.clauses[self.fed:]:
+                self.solver.add_clause(c)
+            self.fed = len(self.cnf.clauses)
+            goal = self.var('Goal_%d' % t)
+            self.solver.add_clause([-goal] + goal_clause)
+            if self.solver.solve([goal]):
+                model = self.cnf.symtab.to_model(self.solver.model)
+                return self.extract_solution(model, t)
+            self.solver.add_clause([-goal])
+        return None
 
 #______________________________________________________________________________
 
-def unify(x, y, s):
+def unify(x, y, s, occurs_check=True):
     """Unify expressions x,y with substitution s; return a substitution that
     would make x,y equal, or None if x,y can not unify. x and y can be
     variables (e.g. Expr('x')), constants, lists, or Exprs. [Fig. 9.1]
+    This copies s into a Bindings store once and unifies there, rather
+    than copying the substitution for every variable bound.
     >>> ppsubst(unify(x + y, y + C, {}))
     {x: y, y: C}
+    >>> unify(x, F(x), {})
+    >>> ppsubst(unify(x, F(x), {}, occurs_check=False))
+    {x: F(x)}
     """
     if s is None:
         return None
-    elif x == y:
+    bindings = Bindings(s, occurs_check)
+    if bindings.unify(x, y):
+        return bindings.substitution()
+    return None
+
+class Bindings:
+    """A mutable substitution, for unification that backtracks.  Each
+    variable bound is pushed on a trail, so undo(mark) unbinds the ones
+    bound since mark().  Bindings are triangular, as in the dicts unify
+    returns: a variable may be bound to a term with bound variables in it,
+    and walk follows the chain.  The occurs check can be turned off, for
+    speed, when no variable can be unified with a term that contains it.
+
+    Terms are taken in a frame, a number: the same variable in different
+    frames is two different variables, so a clause is renamed apart just
+    by using it in a new frame, rather than by copying it with new
+    variables.  A binding maps (variable, frame) to (term, frame).  Frame
+    0 is the default, and the only one a substitution given to or got from
+    the store (as with unify) can hold.
+    >>> b = Bindings()
+    >>> mark = b.mark()
+    >>> b.unify(expr('F(x, G(y))'), expr('F(A, G(x))')), b.resolve(y)
+    (True, A)
+    >>> b.undo(mark); b.resolve(y)
+    y
+    >>> f = b.new_frame()
+    >>> b.unify(expr('F(x, y)'), expr('F(y, A)'), 0, f), b.resolve(x)
+    (True, y__1)
+    """
+
+    def __init__(self, s=None, occurs_check=True):
+        self.values = {}
+        for var, val in (s or {}).items():
+            self.values[(var, 0)] = (val, 0)
+        self.trail = []
+        self.frames = 0
+        self.occurs_check = occurs_check
+
+    def new_frame(self):
+        "A frame number not yet used."
+        self.frames += 1
+        return self.frames
+
+    def mark(self):
+        return len(self.trail)
+
+    def undo(self, mark):
+        "Unbind the variables bound since mark."
+        trail, values = self.trail, self.values
+        while len(trail) > mark:
+            del values[trail.pop()]
+
+    def walk(self, x, frame=0):
+        """Follow the chain of bindings of x in frame to a term that is not
+        a bound variable, and return it with its frame."""
+        values = self.values
+        while isinstance(x, Expr) and not x.args and (x, frame) in values:
+            x, frame = values[(x, frame)]
+        return x, frame
+
+    def unify(self, x, y, fx=0, fy=0):
+        """Extend the bindings to make x in frame fx and y in frame fy equal,
+        and return True; or if they cannot be, leave the bindings as they
+        were and return False."""
+        mark = len(self.trail)
+        pairs = [(x, fx, y, fy)]
+        while pairs:
+            x, fx, y, fy = pairs.pop()
+            x, fx = self.walk(x, fx)
+            y, fy = self.walk(y, fy)
+            if is_variable(x) or is_variable(y):
+                if x is y and fx == fy:
+                    continue
+                if not is_variable(x):
+                    x, fx, y, fy = y, fy, x, fx
+                if self.occurs_check and self.occurs(x, fx, y, fy):
+                    break
+                self.values[(x, fx)] = (y, fy)
+                self.trail.append((x, fx))
+            elif isinstance(x, Expr) and isinstance(y, Expr):
+                if x is y and (fx == fy or not x.args):
+                    continue
+                if x.op != y.op or len(x.args) != len(y.args):
+                    break
+                pairs.extend([(a, fx, b, fy) for (a, b)
+                              in reversed(zip(x.args, y.args))])
+            elif x == y:
+                continue
+            elif isinstance(x, str) or isinstance(y, str):
+                break
+            elif issequence(x) and issequence(y) and len(x) == len(y):
+                pairs.extend([(a, fx, b, fy) for (a, b)
+                              in reversed(zip(x, y))])
+            else:
+                break
+        else:
+            return True
+        self.undo(mark)
+        return False
+
+    def occurs(self, var, fvar, x, fx):
+        "Does var (in frame fvar) occur in x (in frame fx), given the bindings?"
+        terms = [(x, fx)]
+        while terms:
+            x, fx = self.walk(*terms.pop())
+            if x is var and fx == fvar:
+                return True
+            elif isinstance(x, Expr):
+                terms.extend([(arg, fx) for arg in x.args])
+            elif isinstance(x, (list, tuple)):
+                terms.extend([(arg, fx) for arg in x])
+        return False
+
+    def resolve(self, x, frame=0):
+        """Substitute the bindings into x in frame, following chains of
+        bindings.  A variable left unbound in a frame other than 0 is
+        renamed after its frame, as in y__1."""
+        x, frame = self.walk(x, frame)
+        if is_variable(x):
+            if frame:
+                return Expr('%s__%d' % (x.op, frame))
+            return x
+        elif isinstance(x, Expr) and x.args:
+            return Expr(x.op, *[self.resolve(arg, frame) for arg in x.args])
+        return x
+
+    def substitution(self):
+        """The bindings of frame 0, as a substitution (a dict); a binding to
+        a term in another frame has the term resolved."""
+        s = {}
+        for (var, frame), (val, f) in self.values.items():
+            if frame == 0:
+                if f: val = self.resolve(val, f)
+                s[var] = val
         return s
-    elif is_variable(x):
-        return unify_var(x, y, s)
-    elif is_variable(y):
-        return unify_var(y, x, s)
-    elif isinstance(x, Expr) and isinstance(y, Expr):
-        return unify(x.args, y.args, unify(x.op, y.op, s))
-    elif isinstance(x, str) or isinstance(y, str):
-        return None
-    elif issequence(x) and issequence(y) and len(x) == len(y):
-        if not x: return s
-        return unify(x[1:], y[1:], unify(x[0], y[0], s))
-    else:
-        return None
 
 def is_variable(x):
     "A variable is an Expr with no args and a lowercase symbol as the op."
@@ -860,13 +3749,118 @@ def subst(s, x):
         return Expr(x.op, *[subst(s, arg) for arg in x.args])
 
 def fol_fc_ask(KB, alpha):
-    """Inefficient forward chaining for first-order logic. [Fig. 9.3]
-    KB is a FolKB and alpha must be an atomic sentence."""
-    while True:
-        new = {}
-        for r in KB.clauses:
-            ps, q = parse_definite_clause(standardize_variables(r))
-            raise NotImplementedError
+    """Forward chaining for first-order logic. [Fig. 9.3]
+    KB is a FolKB and alpha must be an atomic sentence.  Rather than
+    matching every rule against every fact on each round, this runs the
+    KB's ReteNetwork, and yields a substitution for each fact that matches
+    alpha: first those already in working memory, then those inferred.
+    >>> sorted(map(pretty, fol_fc_ask(test_kb, expr('Hates(x, y)'))))
+    ['{x: Mac, y: MrsRabbit}', '{x: Mac, y: Pete}']
+    >>> [pretty(s) for s in fol_fc_ask(crime_kb, expr('Criminal(x)'))]
+    ['{x: West}']
+    """
+    rete = KB.rete_network()
+    for fact in list(rete.by_predicate.get((alpha.op, len(alpha.args)), ())):
+        theta = unify(alpha, fact, {})
+        if theta is not None:
+            yield theta
+    for fact in rete.run():
+        theta = unify(alpha, fact, {})
+        if theta is not None:
+            yield theta
+
+class ReteNetwork:
+    """A Rete network for forward chaining over definite clauses whose
+    facts are ground atoms.  Each premise of each rule has an alpha memory
+    of the facts that match it, and a beta memory of the partial matches
+    (substitutions) of the premises before it; both are hashed on the
+    values of the variables the premise shares with those before it, so
+    joining a new fact or partial match only looks at consistent partners.
+    A new fact is passed only to the alpha memories of its predicate, and
+    each combination of facts that satisfies a rule is found exactly once.
+    >>> rete = ReteNetwork(map(expr, ['(Parent(x, y) & Parent(y, z)) ==> '
+    ...     'Grandparent(x, z)', 'Parent(Ann, Bob)']))
+    >>> rete.tell(expr('Parent(Bob, Cy)')); list(rete.run())
+    [Parent(Ann, Bob), Parent(Bob, Cy), Grandparent(Ann, Cy)]
+    """
+
+    def __init__(self, clauses=()):
+        self.facts = set()
+        self.by_predicate = {} ## (op, arity) -> facts, in order of arrival
+        self.alpha = {}        ## (op, arity) -> [(ReteRule, premise index)]
+        self.agenda = collections.deque()
+        for c in clauses:
+            self.tell(c)
+
+    def tell(self, sentence):
+        """Add a definite clause.  A fact is queued until run(); a rule is
+        joined with the facts in working memory straight away."""
+        premises, conclusion = parse_definite_clause(sentence)
+        if not premises:
+            self.agenda.append(conclusion)
+            return
+        rule = ReteRule(sentence)
+        for i, p in enumerate(rule.premises):
+            self.alpha.setdefault((p.op, len(p.args)), []).append((rule, i))
+        self.left_activate(rule, 0, {})
+        for i, p in enumerate(rule.premises):
+            for fact in list(self.by_predicate.get((p.op, len(p.args)), ())):
+                self.right_activate(rule, i, fact)
+
+    def run(self):
+        """Add the queued facts to working memory, and with them whatever
+        they let the rules infer; yield each new fact as it is added."""
+        while self.agenda:
+            fact = self.agenda.popleft()
+            if fact not in self.facts:
+                self.facts.add(fact)
+                key = (fact.op, len(fact.args))
+                self.by_predicate.setdefault(key, []).append(fact)
+                for rule, i in self.alpha.get(key, ()):
+                    self.right_activate(rule, i, fact)
+                yield fact
+
+    def right_activate(self, rule, i, fact):
+        "Add fact to the alpha memory of premise i, and join it."
+        binding = unify(rule.premises[i], fact, {})
+        if binding is None:
+            return
+        key = tuple([binding[v] for v in rule.join_vars[i]])
+        rule.alpha_memory[i].setdefault(key, []).append(binding)
+        for token in rule.beta_memory[i].get(key, ()):
+            self.left_activate(rule, i + 1, extend_all(token, binding))
+
+    def left_activate(self, rule, i, token):
+        """Add a match of the premises before i to the beta memory of
+        premise i, and join it; a match of all the premises fires the rule."""
+        if i == len(rule.premises):
+            self.agenda.append(subst(token, rule.conclusion))
+            return
+        key = tuple([token[v] for v in rule.join_vars[i]])
+        rule.beta_memory[i].setdefault(key, []).append(token)
+        for binding in rule.alpha_memory[i].get(key, ()):
+            self.left_activate(rule, i + 1, extend_all(token, binding))
+
+class ReteRule:
+    "The memories for one rule of a ReteNetwork."
+
+    def __init__(self, rule):
+        self.premises, self.conclusion = parse_definite_clause(
+            standardize_variables(rule))
+        self.join_vars = []  ## Variables each premise shares with earlier ones
+        seen = set()
+        for p in self.premises:
+            vs = variables(p)
+            self.join_vars.append(sorted(vs & seen, key=repr))
+            seen |= vs
+        self.alpha_memory = [{} for p in self.premises]
+        self.beta_memory = [{} for p in self.premises]
+
+def extend_all(s, bindings):
+    "Copy the substitution s and extend it with all the bindings."
+    s2 = s.copy()
+    s2.update(bindings)
+    return s2
 
 def standardize_variables(sentence, dic=None):
     """Replace all the variables in sentence with new variables.
@@ -907,25 +3901,117 @@ class FolKB(KB):
     >>> kb0.ask(expr('Wife(Pete, x)'))
     False
     """
-    def __init__(self, initial_clauses=[]):
-        self.clauses = [] # inefficient: no indexing
+    def __init__(self, initial_clauses=[], chaining='backward', tabled=(),
+                 occurs_check=True):
+        self.clauses = []
+        self.chaining = chaining  ## 'backward' or 'forward': see ask_generator
+        self.rete = None          ## The ReteNetwork, once forward chaining
+        self.tabled = set(tabled) ## Predicates that backward chaining tables
+        self.occurs_check = occurs_check  ## For backward chaining's unify
+        self.clear_tables()
+        ## The clauses are indexed on the predicate and arity of their
+        ## heads, and then on the head's first argument when that is a
+        ## constant.  Entries are (n, clause, premises, conclusion), n
+        ## counting the clauses told, so that buckets can be merged back
+        ## into the order of telling; the clause is parsed once, here, and
+        ## backward chaining uses its parts as they are (see fol_bc_ask).
+        self.by_predicate = {} ## (op, arity) -> entries
+        self.by_argument = {}  ## (op, arity, first arg) -> entries
+        self.by_variable = {}  ## (op, arity) -> entries with a non-constant
+                               ## first argument
+        self.counter = itertools.count()
         for clause in initial_clauses:
             self.tell(clause)
 
     def tell(self, sentence):
         if is_definite_clause(sentence):
             self.clauses.append(sentence)
+            lhs, rhs = parse_definite_clause(sentence)
+            entry = (self.counter.next(), sentence, lhs, rhs)
+            for bucket in self.buckets(rhs):
+                bucket.append(entry)
+            if self.rete is not None:
+                self.rete.tell(sentence)
+            self.clear_tables()
         else:
             raise Exception("Not a definite clause: %s" % sentence)
 
     def ask_generator(self, query):
+        "Answer by fol_bc_ask, or by fol_fc_ask if chaining is 'forward'."
+        if self.chaining == 'forward':
+            return fol_fc_ask(self, query)
         return fol_bc_ask(self, query)
 
+    def rete_network(self):
+        """The ReteNetwork of the KB's clauses, which tell keeps up to date
+        (retract discards it, to be rebuilt when next needed)."""
+        if self.rete is None:
+            self.rete = ReteNetwork(self.clauses)
+        return self.rete
+
     def retract(self, sentence):
         self.clauses.remove(sentence)
+        self.rete = None
+        self.clear_tables()
+        for bucket in self.buckets(parse_definite_clause(sentence)[1]):
+            for i, entry in enumerate(bucket):
+                if entry[1] == sentence:
+                    del bucket[i]
+                    break
+
+    def is_tabled(self, goal):
+        "Does backward chaining table goal (see fol_bc_table)?"
+        return goal.op in self.tabled
+
+    def clear_tables(self):
+        "Forget the answer tables, which tell and retract make stale."
+        self.tables = {}       ## variant_key(goal) -> AnswerTable
+        self.table_stack = []  ## Tables being evaluated, outermost first
+        self.incomplete = []   ## Tables evaluated but not yet complete
+        self.answer_count = 0
+
+    def buckets(self, head):
+        "The index buckets that a clause with this head belongs in."
+        key = (head.op, len(head.args))
+        result = [self.by_predicate.setdefault(key, [])]
+        arg = first_arg_key(head)
+        if arg is None:
+            result.append(self.by_variable.setdefault(key, []))
+        else:
+            result.append(self.by_argument.setdefault(key + (arg,), []))
+        return result
 
     def fetch_rules_for_goal(self, goal):
-        return self.clauses
+        """Return the clauses whose heads might unify with goal: those with
+        the same predicate and arity, and, if goal's first argument is a
+        constant, the same constant or a non-constant first argument."""
+        return [entry[1] for entry in
+                self.fetch_entries(goal.op, len(goal.args), first_arg_key(goal))]
+
+    def fetch_definite_clauses(self, op, arity, arg):
+        """Like fetch_rules_for_goal, for a goal given by its predicate, arity
+        and constant first argument (or None); return (premises, conclusion)
+        pairs, as from parse_definite_clause."""
+        return [entry[2:] for entry in self.fetch_entries(op, arity, arg)]
+
+    def fetch_entries(self, op, arity, arg):
+        key = (op, arity)
+        if arg is None:
+            return self.by_predicate.get(key, ())
+        return heapq.merge(self.by_argument.get(key + (arg,), ()),
+                           self.by_variable.get(key, ()))
+
+def first_arg_key(atom):
+    """The first argument of atom, if it is a constant (the key FolKB indexes
+    on); otherwise None.
+    >>> first_arg_key(expr('Loves(Mac, x)')), first_arg_key(expr('Loves(x, Mac)'))
+    (Mac, None)
+    """
+    if atom.args:
+        arg = atom.args[0]
+        if not arg.args and not is_var_symbol(arg.op):
+            return arg
+    return None
 
 def test_ask(query, kb=None):
     q = expr(query)
@@ -979,25 +4065,385 @@ def fol_bc_ask(KB, query):
     ['{x: MrsRabbit}', '{x: Pete}']
     >>> test_ask('Criminal(x)', crime_kb)
     ['{x: West}']
-    """
-    return fol_bc_or(KB, query, {})
 
-def fol_bc_or(KB, goal, theta):
-    for rule in KB.fetch_rules_for_goal(goal):
-        lhs, rhs = parse_definite_clause(standardize_variables(rule))
-        for theta1 in fol_bc_and(KB, lhs, unify(rhs, goal, theta)):
-            yield theta1
-
-def fol_bc_and(KB, goals, theta):
-    if theta is None:
-        pass
-    elif not goals:
+    Rather than passing substitutions (dicts copied for every binding)
+    down the search, fol_bc_or and fol_bc_and share one Bindings store:
+    each extends it, yields, and undoes its bindings on backtracking.  A
+    goal is a literal of a clause together with the frame of the clause's
+    use, and each use of a rule gets a new frame, so rules are never
+    copied to standardize their variables apart.  fol_bc_ask yields the
+    values of the query's variables that are bound, as dicts.
+    """
+    bindings = Bindings(occurs_check=KB.occurs_check)
+    vars = variables(query)
+    for b in fol_bc_or(KB, query, bindings, 0):
+        theta = {}
+        for v in vars:
+            val = b.resolve(v)
+            if val != v: theta[v] = val
         yield theta
+
+def fol_bc_or(KB, goal, bindings, frame):
+    if KB.is_tabled(goal):
+        return fol_bc_table(KB, goal, bindings, frame)
+    return fol_bc_rules(KB, goal, bindings, frame)
+
+def fol_bc_rules(KB, goal, bindings, frame):
+    arg = None
+    if goal.args:
+        arg = bindings.walk(goal.args[0], frame)[0]
+        if arg.args or is_var_symbol(arg.op):
+            arg = None  ## Not a constant, so not indexed on
+    for lhs, rhs in KB.fetch_definite_clauses(goal.op, len(goal.args), arg):
+        mark = bindings.mark()
+        rule_frame = bindings.new_frame()
+        if bindings.unify(rhs, goal, rule_frame, frame):
+            for b in fol_bc_and(KB, lhs, bindings, rule_frame):
+                yield b
+            bindings.undo(mark)
+
+def fol_bc_and(KB, goals, bindings, frame):
+    if not goals:
+        yield bindings
     else:
         first, rest = goals[0], goals[1:]
-        for theta1 in fol_bc_or(KB, subst(theta, first), theta):
-            for theta2 in fol_bc_and(KB, rest, theta1):
-                yield theta2
+        for b in fol_bc_or(KB, first, bindings, frame):
+            for b2 in fol_bc_and(KB, rest, bindings, frame):
+                yield b2
+
+## Tabling.  A goal whose predicate the KB tables is not solved by
+## resolving it against the rules every time it comes up.  Instead, the
+## answers to each variant of the goal (the same up to renaming of
+## variables) are collected, once, in an AnswerTable that every call of
+## the variant then reads.  A call that meets a variant that is still
+## being evaluated further up the stack, as with a left-recursive rule,
+## reads the answers found so far rather than recursing.  Variants that
+## call each other this way are evaluated again and again, from the oldest
+## of them (the leader), until a pass finds no new answers; then they are
+## all complete.  This is linear tabling, a simpler relative of SLG
+## resolution that gives the same answers for definite clauses.
+
+class AnswerTable:
+    "The answers to one variant of a tabled goal."
+
+    def __init__(self):
+        self.answers = []    ## (answer atom, has variables), in the order found
+        self.found = set()
+        self.complete = False
+        self.active = False  ## Being evaluated
+        self.depth = self.lowlink = None
+
+def fol_bc_table(KB, goal, bindings, frame):
+    """Extend bindings to solve goal (in frame) for each answer in the table
+    for goal's variant, and yield them; evaluate the table first if needed.
+    >>> kb = FolKB(map(expr, ['Mother(MrsMac, Mac)', 'Farmer(Mac)',
+    ...     'Farmer(f) ==> Human(f)',
+    ...     '(Human(h) & Mother(m, h)) ==> Human(m)']), tabled=['Human'])
+    >>> sorted(pretty(s[x]) for s in fol_bc_ask(kb, expr('Human(x)')))
+    ['Mac', 'MrsMac']
+    """
+    g = bindings.resolve(goal, frame)
+    key = variant_key(g)
+    table = KB.tables.get(key)
+    if table is None:
+        table = KB.tables[key] = AnswerTable()
+    if not (table.complete or table.active):
+        evaluate_table(KB, table, g)
+    if not table.complete and KB.table_stack:
+        caller = KB.table_stack[-1]
+        caller.lowlink = min(caller.lowlink,
+                             if_(table.active, table.depth, table.lowlink))
+    for answer, has_variables in list(table.answers):
+        mark = bindings.mark()
+        answer_frame = 0
+        if has_variables:
+            answer_frame = bindings.new_frame()
+        if bindings.unify(goal, answer, frame, answer_frame):
+            yield bindings
+            bindings.undo(mark)
+
+def evaluate_table(KB, table, goal):
+    """Resolve goal against the KB's rules, adding new answers to table.
+    If table is a leader, repeat until a pass adds no answers to any table,
+    and then mark it and the incomplete tables it called complete."""
+    table.active = True
+    table.depth = table.lowlink = len(KB.table_stack)
+    KB.table_stack.append(table)
+    KB.incomplete.append(table)
+    while True:
+        count = KB.answer_count
+        bindings = Bindings(occurs_check=KB.occurs_check)
+        for b in fol_bc_rules(KB, goal, bindings, 0):
+            answer = variant_key(b.resolve(goal))
+            if answer not in table.found:
+                table.found.add(answer)
+                table.answers.append((answer, bool(variables(answer))))
+                KB.answer_count += 1
+        if table.lowlink < table.depth:
+            break  ## Not a leader; the leader will evaluate table again
+        if KB.answer_count == count:
+            while True:
+                t = KB.incomplete.pop()
+                t.complete = True
+                if t is table: break
+            break
+    KB.table_stack.pop()
+    table.active = False
+
+def subst_bindings(s, x):
+    """Like subst, but follow chains of bindings, so that no variable that s
+    binds is left in the result.
+    >>> subst_bindings({x: y, y: A}, F(x, y, z))
+    F(A, A, z)
+    """
+    if is_variable(x):
+        if x in s:
+            return subst_bindings(s, s[x])
+        return x
+    elif isinstance(x, Expr) and x.args:
+        return Expr(x.op, *[subst_bindings(s, arg) for arg in x.args])
+    return x
+
+def variant_key(x, names=None):
+    """Rename the variables in x in order of occurrence, so that two atoms
+    that differ only in their variables' names give the same key.
+    >>> variant_key(expr('F(x, y, x)')) == variant_key(expr('F(b, a, b)'))
+    True
+    """
+    if names is None: names = {}
+    if is_variable(x):
+        if x not in names:
+            names[x] = Expr('t_%d' % len(names))
+        return names[x]
+    elif isinstance(x, Expr) and x.args:
+        return Expr(x.op, *[variant_key(arg, names) for arg in x.args])
+    return x
+
+#______________________________________________________________________________
+# Datalog: bottom-up, semi-naive evaluation of function-free definite clauses
+
+class DatalogKB(KB):
+    """A KB of function-free definite clauses whose facts are ground, with
+    every variable of a rule's conclusion appearing in its premises.  All
+    the facts that follow are computed bottom up, as relations of tuples of
+    constants, and queries are answered by looking them up.  Evaluation is
+    semi-naive: each round joins only the facts that are new since the last
+    round (the delta) with the rest, and it resumes from where it left off
+    when more clauses are told; a retract starts over.
+    >>> kb = DatalogKB(crime_kb.clauses)
+    >>> [pretty(s) for s in kb.ask_generator(expr('Criminal(x)'))]
+    ['{x: West}']
+    >>> kb.tell(expr('(Criminal(x) & Sells(x, y, z)) ==> Fined(x, z)'))
+    >>> kb.ask(expr('Fined(West, z)'))[z]
+    Nono
+    """
+
+    def __init__(self, initial_clauses=[]):
+        self.clauses = []
+        self.reset()
+        for clause in initial_clauses:
+            self.tell(clause)
+
+    def reset(self):
+        self.rules = []         ## DatalogRules
+        self.relations = {}     ## (op, arity) -> Relation
+        self.delta = {}         ## (op, arity) -> tuples new since last round
+        self.new_rules = []     ## Rules not yet joined with all the facts
+
+    def tell(self, sentence):
+        if not is_definite_clause(sentence):
+            raise Exception("Not a definite clause: %s" % sentence)
+        self.clauses.append(sentence)
+        premises, conclusion = parse_definite_clause(sentence)
+        if premises:
+            rule = DatalogRule(premises, conclusion)
+            self.rules.append(rule)
+            self.new_rules.append(rule)
+        else:
+            if variables(conclusion):
+                raise Exception("Datalog facts must be ground: %s" % sentence)
+            self.add_fact(atom_key(conclusion), datalog_tuple(conclusion))
+
+    def ask_generator(self, query):
+        "Yield a substitution for each fact that matches query."
+        self.fixpoint()
+        relation = self.relations.get(atom_key(query))
+        if relation is None:
+            return
+        atom = DatalogAtom(query)
+        for t in relation.lookup(atom.positions({})):
+            theta = match_tuple(atom, t, {})
+            if theta is not None:
+                yield theta
+
+    def retract(self, sentence):
+        self.clauses.remove(sentence)
+        clauses, self.clauses = self.clauses, []
+        self.reset()
+        for clause in clauses:
+            self.tell(clause)
+
+    def add_fact(self, key, t):
+        relation = self.relations.get(key)
+        if relation is None:
+            relation = self.relations[key] = Relation()
+        if relation.add(t):
+            self.delta.setdefault(key, []).append(t)
+
+    def fixpoint(self):
+        "Derive every fact that follows from the clauses told."
+        new_rules, self.new_rules = self.new_rules, []
+        for rule in new_rules:
+            ## A rule's first evaluation joins all the facts, naively.
+            for key, t in rule.evaluate(self.relations):
+                self.add_fact(key, t)
+        while self.delta:
+            delta, self.delta = self.delta, {}
+            for rule in self.rules:
+                for i, atom in enumerate(rule.premises):
+                    if atom.key in delta:
+                        for key, t in rule.evaluate(self.relations, i,
+                                                    delta[atom.key]):
+                            self.add_fact(key, t)
+
+class Relation:
+    """A set of tuples, with a hash index for each set of positions whose
+    values have been looked up."""
+
+    def __init__(self):
+        self.tuples = set()
+        self.indexes = {}  ## positions -> {values at positions: [tuples]}
+
+    def __len__(self):
+        return len(self.tuples)
+
+    def add(self, t):
+        "Add tuple t; return True if it is new."
+        if t in self.tuples:
+            return False
+        self.tuples.add(t)
+        for positions, index in self.indexes.items():
+            index.setdefault(tuple([t[p] for p in positions]), []).append(t)
+        return True
+
+    def lookup(self, bound):
+        """The tuples with the given values at the given positions; bound is
+        a list of (position, value) pairs."""
+        if not bound:
+            return self.tuples
+        positions = tuple([p for p, v in bound])
+        index = self.indexes.get(positions)
+        if index is None:
+            index = self.indexes[positions] = {}
+            for t in self.tuples:
+                index.setdefault(tuple([t[p] for p in positions]), []).append(t)
+        return index.get(tuple([v for p, v in bound]), ())
+
+class DatalogAtom:
+    "An atom of a Datalog rule: its relation's key, and its arguments."
+
+    def __init__(self, atom):
+        self.key = atom_key(atom)
+        self.args = atom.args
+        for arg in self.args:
+            if arg.args:
+                raise Exception("Datalog atoms must be function-free: %s"
+                                % atom)
+
+    def positions(self, theta):
+        "The (position, value) pairs fixed by constants and by theta."
+        bound = []
+        for p, arg in enumerate(self.args):
+            if is_variable(arg):
+                if arg in theta:
+                    bound.append((p, theta[arg]))
+            else:
+                bound.append((p, arg))
+        return bound
+
+class DatalogRule:
+    "A Datalog rule, with premises that are DatalogAtoms."
+
+    def __init__(self, premises, conclusion):
+        self.premises = map(DatalogAtom, premises)
+        self.conclusion = DatalogAtom(conclusion)
+        if not variables(conclusion) <= variables(associate('&', premises)):
+            raise Exception("Every variable of the conclusion must be in "
+                            "a premise: %s" % conclusion)
+
+    def evaluate(self, relations, i=None, delta=None):
+        """Return the (key, tuple) facts the rule concludes from relations;
+        if i is given, premise i must match a tuple from delta."""
+        if i is None:
+            order, thetas = self.premises, [{}]
+        else:
+            order = self.premises[:i] + self.premises[i+1:]
+            atom = self.premises[i]
+            thetas = [theta for theta in [match_tuple(atom, t, {})
+                                          for t in delta]
+                      if theta is not None]
+        for atom in order:
+            relation = relations.get(atom.key)
+            if relation is None:
+                return []
+            thetas = [theta2 for theta in thetas
+                      for t in relation.lookup(atom.positions(theta))
+                      for theta2 in [match_tuple(atom, t, theta)]
+                      if theta2 is not None]
+        conclusion = self.conclusion
+        return [(conclusion.key,
+                 tuple([theta.get(arg, arg) for arg in conclusion.args]))
+                for theta in thetas]
+
+def match_tuple(atom, t, theta):
+    """Extend theta so that the DatalogAtom atom matches the tuple t of
+    constants, or return None if it cannot."""
+    theta2 = theta
+    for arg, value in zip(atom.args, t):
+        if is_variable(arg):
+            if arg not in theta2:
+                if theta2 is theta: theta2 = theta.copy()
+                theta2[arg] = value
+            elif theta2[arg] != value:
+                return None
+        elif arg != value:
+            return None
+    return theta2
+
+def atom_key(atom):
+    "The relation of an atom: its predicate and arity."
+    return (atom.op, len(atom.args))
+
+def datalog_tuple(fact):
+    "The tuple of constants for a ground fact."
+    return tuple(fact.args)
+
+def compare_datalog_engines(chains=10000, length=10, queries=100):
+    """Time the engines on transitive closure over chains of Edge facts
+    (chains * length of them).  Print a table of the seconds each takes to
+    answer Path(start, y) for the start of each of the first few chains,
+    to then find all of Path(x, y), and to answer the first queries again;
+    and the number of answers to the last two."""
+    import time
+    clauses = [expr('Edge(N%d_%d, N%d_%d)' % (c, i, c, i + 1))
+               for c in range(chains) for i in range(length)]
+    clauses += map(expr, ['Edge(x, y) ==> Path(x, y)',
+                          '(Edge(x, y) & Path(y, z)) ==> Path(x, z)'])
+    goals = [expr('Path(N%d_0, y)' % c) for c in range(min(queries, chains))]
+    closure = [expr('Path(x, y)')]
+    engines = [('fol_bc_ask', FolKB),
+               ('fol_bc_ask, tabled', lambda cs: FolKB(cs, tabled=['Path'])),
+               ('DatalogKB', DatalogKB)]
+    table = []
+    for name, make_kb in engines:
+        kb = make_kb(clauses)
+        row = [name]
+        for qs in (goals, closure, goals):
+            start = time.time()
+            answers = sum([len(list(kb.ask_generator(q))) for q in qs])
+            row.append('%.2f' % (time.time() - start))
+        table.append(row + [answers])
+    print_table(table, ['Engine', 'Queries', 'Closure', 'Again', 'Answers'])
 
 #______________________________________________________________________________
 
@@ -16,7 +16,8 @@ class AgentWW(agents.Agent):
     """ Agent for the wumpus world.
     """
     def __init__(self):
-        self.KB = logic.PropKB()
+        self.KB = logic.IncrementalPropKB()
+        self.size = 4
         self.location = (1, 1)
         self.orientation = 0
         self.visited = set()
@@ -48,21 +49,18 @@ class AgentWW(agents.Agent):
             elif self.path:
                 self.action = self.path.pop()
             else:
-                safe_moves = set()
-                for [i, j] in self.frontier():
-                    query = '~P%d%d & ~W_%d%d' % (i, j, i, j)
-                    if self.KB.ask(logic.Expr(query)) != False:
-                        safe_moves.append((i, j))
-
-                valid_moves = safe_moves.difference(self.visited())
-                adj_moves = get_adj(self.location)
-                best_move = adj_moves.intersection(valid_moves)
-
-                if best_move is not None:
-                    best_move = best_move[0]
-                    self.get_path(best_move)
+                safe_moves = self.safe_cells(self.frontier())
+
+                valid_moves = safe_moves.difference(self.visited)
+                adj_moves = self.get_adj(self.location)
+                best_move = valid_moves.intersection(adj_moves)
+
+                if best_move:
+                    self.get_path(sorted(best_move)[0])
                 else:
-                    self.action = random.choice(['ROTATE_LEFT', 'ROTATE_RIGHT', 'MOVE'])
+                    unvisited = [c for c in adj_moves if c not in self.visited]
+                    self.get_path(self.least_risky(unvisited or adj_moves))
+                self.action = self.path.pop()
 
                 # Add the action to the KB.
 
@@ -74,7 +72,8 @@ class AgentWW(agents.Agent):
         """ Gets the path for the best action
         """
         # Make sure the agent is orientated the correct way.
-        (i, j) = self.location - self.best_move
+        (i, j) = (self.location[0] - best_move[0],
+                  self.location[1] - best_move[1])
         if i == 0:
             if j > 0:
                 goal_orientation = 3
@@ -86,10 +85,58 @@ class AgentWW(agents.Agent):
             else:
                 goal_orientation = 0
 
-        cur_orientation = self.orientation
-        while cur_orientation != goal_orientation:
-            # Make this work with rotate right too.
-            self.path.append('ROTATE_LEFT')
+        # The path is popped from the end, so the move goes in first.
+        self.path.append('MOVE')
+        turns = (goal_orientation - self.orientation) % 4
+        if turns == 3:
+            self.path.append('ROTATE_RIGHT')
+        else:
+            self.path.extend(['ROTATE_LEFT'] * turns)
+
+    def safe_cells(self, cells):
+        """ Gets the cells that the KB proves to hold neither a pit nor the
+            wumpus, with one backbone query for all of them.
+        """
+        symbols = {}
+        for (i, j) in cells:
+            symbols[i, j] = (logic.expr('P%d%d' % (i, j)),
+                             logic.expr('W%d%d' % (i, j)))
+        forced = self.KB.backbone([s for pw in symbols.values() for s in pw])
+        if forced is None:
+            return set()
+        return set(c for c, (pit, wumpus) in symbols.items()
+                   if forced[pit] is False and forced[wumpus] is False)
+
+    def least_risky(self, cells):
+        """ Gets the cell least likely to hold a pit or the wumpus, given the
+            KB and the 0.2 chance of a pit in each cell. A wumpus symbol the
+            KB says nothing about, such as W11, is taken to be false.
+        """
+        mentioned = set(s for c in self.KB.clauses
+                        for s in logic.prop_symbols(c))
+        pits = dict(((i, j), logic.expr('P%d%d' % (i, j)))
+                    for i in range(1, self.size + 1)
+                    for j in range(1, self.size + 1))
+        weights = dict((pit, 0.2) for pit in pits.values())
+        risks = {}
+        for (i, j) in cells:
+            risks[i, j] = [pits[i, j]]
+            wumpus = logic.expr('W%d%d' % (i, j))
+            if wumpus in mentioned:
+                risks[i, j].append(wumpus)
+        probs = logic.marginals(self.KB.clauses,
+                                [s for ss in risks.values() for s in ss],
+                                weights=weights)
+        if probs is None:
+            return cells[0]
+
+        def risk(cell):
+            safe = 1
+            for s in risks[cell]:
+                safe *= 1 - probs[s]
+            return 1 - safe
+
+        return min(cells, key=risk)
 
     def get_adj(self, location):
         """ Gets the adjacent cells.
@@ -154,8 +201,9 @@ class AgentWW(agents.Agent):
         if self.action == 'ROTATE_LEFT':
             self.orientation = (self.orientation + 1) % 4
         elif self.action == 'ROTATE_RIGHT':
-            self.orientation = (orientation - 1) % 4
+            self.orientation = (self.orientation - 1) % 4
         elif self.action == 'MOVE':
+            (i, j) = self.location
             if self.orientation == 2 and i - 1 > 0:
                 self.location = (i - 1, j)
             elif self.orientation == 3 and j - 1 > 0: